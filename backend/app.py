@@ -1,17 +1,38 @@
 import os
-from typing import List, Dict, Optional
+import json
+import base64
+import binascii
+import asyncio
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Query, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
-from groq import Groq
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, EmailStr, ValidationError
+import anyio
+import groq
 import time
 from datetime import datetime
 
 # Import our modules
 import database
+import async_db
+import archive
 import auth
-from auth import get_current_user, get_password_hash, verify_password, create_access_token
+import context
+import history
+import metrics
+import compression
+import ratelimit
+import responses
+import shards
+from catalog import catalog
+from cache import response_cache, make_key, LLM_CACHE_ENABLED
+from singleflight import llm_flights
+from writebehind import save_turn, turn_writer
+from scheduler import llm_scheduler, retry_stats, Overloaded
+from router import llm_router
+from auth import get_current_user, hash_password_async, verify_password_async, create_access_token
 
 load_dotenv()
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
@@ -29,10 +50,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "ETag"],
 )
 
-# Initialize Groq client
-client = Groq(api_key=GROQ_API_KEY)
+# gzip/Brotli for large JSON responses (runs inside the timing middleware)
+app.add_middleware(responses.CompressionMiddleware)
+
+# Request latency histogram and per-stage Server-Timing header
+app.add_middleware(metrics.TimingMiddleware)
 
 # Pydantic models
 class UserRegister(BaseModel):
@@ -53,6 +78,7 @@ class Token(BaseModel):
 class ChatMessage(BaseModel):
     message: str
     conversation_id: Optional[int] = None
+    use_cache: bool = True
 
 class ConversationCreate(BaseModel):
     title: str
@@ -64,28 +90,61 @@ class ConversationUpdate(BaseModel):
 @app.on_event("startup")
 async def startup_event():
     database.initialize_database()
+    auth.start_hash_pool()
+    catalog.load()
+    if compression.active_codec() is not None:
+        app.state.compression_task = asyncio.create_task(compress_stored_messages())
+    if archive.ARCHIVE_IDLE_DAYS > 0:
+        app.state.archive_task = asyncio.create_task(archive_idle_conversations())
+    app.state.usage_task = asyncio.create_task(ratelimit.llm_usage.run())
+
+async def compress_stored_messages():
+    """Compress messages stored before compression was enabled, one batch per transaction."""
+    for shard in range(shards.DB_SHARDS):
+        last_id = await async_db.compress_message_batch(shard=shard)
+        while last_id is not None:
+            last_id = await async_db.compress_message_batch(last_id, shard=shard)
+
+async def archive_idle_conversations():
+    """Periodically move idle conversations out of the main database."""
+    while True:
+        while await async_db.archive_idle_conversations() >= archive.ARCHIVE_BATCH_SIZE:
+            pass
+        await asyncio.sleep(archive.ARCHIVE_INTERVAL_SECONDS)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task_name in ("compression_task", "archive_task", "usage_task"):
+        task = getattr(app.state, task_name, None)
+        if task is not None:
+            task.cancel()
+    await ratelimit.llm_usage.flush()
+    turn_writer.close()
+    auth.shutdown_hash_pool()
+    async_db.shutdown()
+    database.close_pools()
 
 # Authentication endpoints
-@app.post("/auth/register", response_model=Dict)
+@app.post("/auth/register", response_model=Dict, dependencies=[Depends(ratelimit.limit_auth_attempts)])
 async def register(user_data: UserRegister):
     """Register a new user."""
     # Check if username already exists
-    if database.get_user_by_username(user_data.username):
+    if await async_db.get_user_by_username(user_data.username):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already registered"
         )
     
     # Check if email already exists
-    if database.get_user_by_email(user_data.email):
+    if await async_db.get_user_by_email(user_data.email):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
         )
     
     # Hash password and create user
-    password_hash = get_password_hash(user_data.password)
-    user_id = database.create_user(user_data.username, user_data.email, password_hash)
+    password_hash = await hash_password_async(user_data.password)
+    user_id = await async_db.create_user(user_data.username, user_data.email, password_hash)
     
     if not user_id:
         raise HTTPException(
@@ -95,22 +154,27 @@ async def register(user_data: UserRegister):
     
     return {"message": "User created successfully", "user_id": user_id}
 
-@app.post("/auth/login", response_model=Token)
+@app.post("/auth/login", response_model=Token, dependencies=[Depends(ratelimit.limit_auth_attempts)])
 async def login(user_data: UserLogin):
     """Login user and return JWT token."""
-    user = database.get_user_by_username(user_data.username)
+    user = await async_db.get_user_by_username(user_data.username)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password"
         )
     
-    if not verify_password(user_data.password, user["password_hash"]):
+    valid, new_hash = await verify_password_async(user_data.password, user["password_hash"])
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password"
         )
     
+    # Transparently upgrade hashes made with outdated settings (e.g. cost factor)
+    if new_hash:
+        await async_db.update_user_password_hash(user["id"], new_hash)
+    
     # Create access token
     access_token = create_access_token(data={"sub": str(user["id"]), "username": user["username"]})
     
@@ -124,7 +188,7 @@ async def login(user_data: UserLogin):
 @app.get("/auth/me")
 async def get_current_user_info(current_user_id: int = Depends(get_current_user)):
     """Get current user information."""
-    user = database.get_user_by_id(current_user_id)
+    user = await async_db.get_user_by_id(current_user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -133,11 +197,60 @@ async def get_current_user_info(current_user_id: int = Depends(get_current_user)
     return user
 
 # Conversation management endpoints
+MAX_PAGE_SIZE = 200
+
+def encode_conversation_cursor(conversation: Dict) -> str:
+    """Opaque cursor holding the (updated_at, id) sort position of a conversation."""
+    position = f"{conversation['updated_at']}|{conversation['id']}"
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_conversation_cursor(cursor: str) -> Tuple[str, int]:
+    """Inverse of encode_conversation_cursor; 400 for anything it did not produce."""
+    try:
+        position = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        updated_at, _, conversation_id = position.rpartition("|")
+        if not updated_at:
+            raise ValueError(position)
+        return updated_at, int(conversation_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
 @app.get("/conversations")
-async def get_conversations(current_user_id: int = Depends(get_current_user)):
-    """Get all conversations for the current user."""
-    conversations = database.get_user_conversations(current_user_id)
-    return {"conversations": conversations}
+async def get_conversations(
+    request: Request,
+    before: Optional[str] = Query(None, description="`next_cursor` of the previous page"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    current_user_id: int = Depends(get_current_user)
+):
+    """Get the current user's conversations, most recent first.
+    
+    Without `limit` every conversation is returned. With it, pass the returned
+    `next_cursor` as `before` to fetch the next page. Answers 304 when the
+    `If-None-Match` ETag still matches.
+    
+    The cursor records the sort position of the last conversation returned,
+    so pages stay consistent when conversations are updated or deleted in
+    between.
+    """
+    position = decode_conversation_cursor(before) if before is not None else None
+    conversations = await async_db.get_user_conversations(
+        current_user_id, position, limit + 1 if limit else None
+    )
+    next_cursor = None
+    if limit and len(conversations) > limit:
+        conversations = conversations[:limit]
+        next_cursor = encode_conversation_cursor(conversations[-1])
+    
+    # The rows hold no message content, so hashing them is cheap and exact
+    etag = responses.make_etag(
+        [(c["id"], c["title"], c["updated_at"], c["archived_at"]) for c in conversations], next_cursor
+    )
+    if responses.is_not_modified(request, etag):
+        return responses.not_modified(etag)
+    return responses.cacheable_json({"conversations": conversations, "next_cursor": next_cursor}, etag)
 
 @app.post("/conversations")
 async def create_conversation(
@@ -145,7 +258,7 @@ async def create_conversation(
     current_user_id: int = Depends(get_current_user)
 ):
     """Create a new conversation."""
-    conversation_id = database.create_conversation(current_user_id, conversation_data.title)
+    conversation_id = await async_db.create_conversation(current_user_id, conversation_data.title)
     if not conversation_id:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -154,19 +267,62 @@ async def create_conversation(
     
     return {"conversation_id": conversation_id, "title": conversation_data.title}
 
+def conversation_validators(version: Dict, before: Optional[int], limit: Optional[int]) -> Tuple[str, Optional[str]]:
+    """ETag and Last-Modified of one page of a conversation."""
+    etag = responses.make_etag(
+        version["id"], version["title"], version["updated_at"], version["archived_at"],
+        version["last_message_id"], before, limit
+    )
+    return etag, responses.http_date(version["updated_at"])
+
 @app.get("/conversations/{conversation_id}")
 async def get_conversation(
+    request: Request,
     conversation_id: int,
+    before: Optional[int] = Query(None, description="Return messages older than this message ID"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
     current_user_id: int = Depends(get_current_user)
 ):
-    """Get a specific conversation with all its messages."""
-    conversation = database.get_conversation_with_messages(conversation_id, current_user_id)
+    """Get a specific conversation with its messages.
+    
+    Without `limit` every message is returned. With it, the newest `limit`
+    messages (before `before`) are returned; pass `next_cursor` as `before`
+    to load older ones.
+    
+    The ETag comes from the conversation's title, `updated_at` and latest
+    message ID, so a matching `If-None-Match` is answered with 304 without
+    loading any messages.
+    """
+    version = await async_db.get_conversation_version(conversation_id, current_user_id)
+    if not version:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Conversation not found"
+        )
+    
+    etag, last_modified = conversation_validators(version, before, limit)
+    if responses.is_not_modified(request, etag, last_modified):
+        return responses.not_modified(etag, last_modified)
+    
+    conversation = await async_db.get_conversation_with_messages(
+        conversation_id, current_user_id, before, limit + 1 if limit else None
+    )
     if not conversation:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Conversation not found"
         )
-    return conversation
+    
+    if version["archived_at"] is not None:
+        # Loading rehydrated it: the next request will see the live version
+        version = await async_db.get_conversation_version(conversation_id, current_user_id) or version
+        etag, last_modified = conversation_validators(version, before, limit)
+    
+    conversation["next_cursor"] = None
+    if limit and len(conversation["messages"]) > limit:
+        conversation["messages"] = conversation["messages"][-limit:]
+        conversation["next_cursor"] = conversation["messages"][0]["id"]
+    return responses.cacheable_json(conversation, etag, last_modified)
 
 @app.put("/conversations/{conversation_id}")
 async def update_conversation(
@@ -175,7 +331,7 @@ async def update_conversation(
     current_user_id: int = Depends(get_current_user)
 ):
     """Update conversation title."""
-    success = database.update_conversation_title(conversation_id, current_user_id, conversation_data.title)
+    success = await async_db.update_conversation_title(conversation_id, current_user_id, conversation_data.title)
     if not success:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -189,7 +345,7 @@ async def delete_conversation(
     current_user_id: int = Depends(get_current_user)
 ):
     """Delete a conversation and all its messages."""
-    success = database.delete_conversation(conversation_id, current_user_id)
+    success = await async_db.delete_conversation(conversation_id, current_user_id)
     if not success:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -197,48 +353,205 @@ async def delete_conversation(
         )
     return {"message": "Conversation deleted successfully"}
 
-# Chat functionality
-def query_groq_api(messages: List[Dict[str, str]]) -> str:
-    """Make a request to the Groq API."""
+@app.get("/search")
+async def search(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user_id: int = Depends(get_current_user)
+):
+    """Full-text search over the current user's chat history.
+    
+    Results are ranked by relevance; matches in `snippet` are wrapped in <mark>.
+    Pass `next_offset` as `offset` to get the next page.
+    """
+    results = await async_db.search_messages(current_user_id, q, limit + 1, offset)
+    next_offset = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_offset = offset + limit
+    return {"results": results, "next_offset": next_offset}
+
+# History export and import
+@app.get("/export")
+async def export_history(current_user_id: int = Depends(get_current_user)):
+    """Stream all of the current user's conversations and messages as NDJSON."""
+    return StreamingResponse(
+        async_db.iterate(database.export_user_history(current_user_id)),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="anime-haven-history.ndjson"'},
+    )
+
+@app.post("/import")
+async def import_history(request: Request, current_user_id: int = Depends(get_current_user)):
+    """Import an NDJSON export into the current user's account as new conversations.
+    
+    The body is read as a stream and written in batched transactions; if a
+    batch fails, the batches before it stay imported.
+    """
+    conversation_ids: Dict[int, int] = {}
+    seen = set()
+    totals = {"conversations": 0, "messages": 0}
+    batch = []
+    
+    async def flush():
+        written = await async_db.import_history_batch(current_user_id, batch, conversation_ids)
+        if written is None:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Import failed after {totals['conversations']} conversations and {totals['messages']} messages"
+            )
+        for key in totals:
+            totals[key] += written[key]
+        batch.clear()
+    
+    line_number = 0
     try:
-        start_time = time.time()
-        
-        completion = client.chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=messages,
-            temperature=1,
-            max_tokens=1024,
-            top_p=1,
-            stream=True,
-            stop=None,
+        async for line in history.aiter_lines(request.stream()):
+            line_number += 1
+            record = history.parse_record(line, line_number, seen)
+            if record is not None:
+                batch.append(record)
+                if len(batch) >= history.IMPORT_BATCH_ROWS:
+                    await flush()
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid export ({totals['conversations']} conversations imported before the error): {e}"
         )
-        
-        response = ""
-        for chunk in completion:
-            response += chunk.choices[0].delta.content or ""
-        
-        end_time = time.time()
-        response_time = end_time - start_time
-        print(f"API Response Time: {response_time:.2f} seconds")
-        
-        return response
+    if batch:
+        await flush()
     
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error with Groq API: {str(e)}")
+    return {"message": "History imported successfully", **totals}
 
-@app.post("/chat")
-async def chat(
-    chat_data: ChatMessage,
+# Catalog recommendations (answered locally, no LLM call)
+@app.get("/recommend")
+async def recommend(
+    title: str = Query(..., min_length=1, max_length=200),
+    k: int = Query(5, ge=1, le=20),
     current_user_id: int = Depends(get_current_user)
 ):
-    """Send a message and get AI response."""
+    """Recommend catalog titles similar to the given one."""
+    recommendations = catalog.similar_to(title, k)
+    if recommendations is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Title not found in catalog"
+        )
+    return recommendations
+
+# Chat functionality
+SYSTEM_PROMPT = "You are a Anime Expert and will help the user find the best anime for them. Be enthusiastic about anime and provide detailed recommendations with explanations."
+
+async def stream_groq_api(
+    messages: List[Dict[str, str]],
+    max_tokens: int = 1024,
+    user_key: str = "anonymous",
+    route: Optional[Dict] = None
+) -> AsyncIterator[str]:
+    """Stream response deltas from the LLM as they arrive.
+    
+    The call waits for an admission slot from llm_scheduler (fair per user_key)
+    and llm_router picks, hedges and falls back between backends until the
+    first delta arrives. `route` receives the backend that won.
+    """
+    start_time = time.perf_counter()
+    first_token = True
+    parts: List[str] = []
+    usage = None
+    outcome = "error"
+    try:
+        async with llm_scheduler.slot(user_key):
+            async for chunk in llm_router.stream(messages, max_tokens, route):
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq is not None and getattr(x_groq, "usage", None) is not None:
+                    usage = x_groq.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token:
+                        first_token = False
+                        metrics.observe_stage("llm_ttft", time.perf_counter() - start_time)
+                    parts.append(delta)
+                    yield delta
+        outcome = "ok"
+    except Overloaded:
+        outcome = "shed"
+        raise
+    finally:
+        metrics.observe_stage("llm_total", time.perf_counter() - start_time)
+        metrics.LLM_REQUESTS.inc(1, outcome)
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens = sum(context.message_tokens(msg) for msg in messages)
+            completion_tokens = context.count_tokens("".join(parts))
+        metrics.LLM_TOKENS.inc(prompt_tokens, "prompt")
+        metrics.LLM_TOKENS.inc(completion_tokens, "completion")
+        # Charged to the user's daily quota (background summaries are not):
+        # the provider's reported usage, else the estimate for a completed
+        # call. Failed and cancelled calls without reported usage are free.
+        if user_key.isdigit() and (usage is not None or outcome == "ok"):
+            ratelimit.llm_usage.record(int(user_key), prompt_tokens + completion_tokens)
+
+def completion_key(messages: List[Dict[str, str]], max_tokens: int = 1024) -> str:
+    """Key of a completion: the messages plus the backends/models the router would use for them."""
+    return make_key(llm_router.route_key(messages, max_tokens), messages)
+
+def stream_completion(
+    messages: List[Dict[str, str]],
+    max_tokens: int = 1024,
+    user_key: str = "anonymous",
+    route: Optional[Dict] = None
+) -> AsyncIterator[str]:
+    """Stream a completion, sharing one upstream call between identical concurrent requests.
+    
+    `route` is filled in with the serving backend once the stream ends.
+    """
+    return llm_flights.stream(completion_key(messages, max_tokens), lambda info: stream_groq_api(messages, max_tokens, user_key, info), route)
+
+def llm_http_error(error: Exception) -> HTTPException:
+    """Map an LLM failure to the HTTP error returned to the client."""
+    if isinstance(error, HTTPException):
+        return error
+    if isinstance(error, Overloaded):
+        retry_after = error.retry_after
+    elif isinstance(error, groq.RateLimitError):
+        retry_after = error.response.headers.get("retry-after", "1")
+    else:
+        return HTTPException(status_code=500, detail=f"Error with Groq API: {str(error)}")
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="The recommendation service is busy, please try again shortly",
+        headers={"Retry-After": str(retry_after)},
+    )
+
+async def query_groq_api(
+    messages: List[Dict[str, str]],
+    max_tokens: int = 1024,
+    user_key: str = "anonymous",
+    route: Optional[Dict] = None
+) -> str:
+    """Make a request to the Groq API."""
+    try:
+        return "".join([delta async for delta in stream_completion(messages, max_tokens, user_key, route)])
+    except Exception as e:
+        raise llm_http_error(e)
+
+async def summarize_messages(messages: List[Dict[str, str]]) -> str:
+    """Summarizer used by context.refresh_summary."""
+    return await query_groq_api(messages, max_tokens=context.SUMMARY_MAX_TOKENS, user_key="background")
+
+async def resolve_conversation(chat_data: ChatMessage, current_user_id: int) -> int:
+    """Create the conversation for a chat turn, or check the user owns the given one."""
     conversation_id = chat_data.conversation_id
     
     # If no conversation_id provided, create a new conversation
     if not conversation_id:
         # Create a new conversation with a default title
         title = f"Chat {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-        conversation_id = database.create_conversation(current_user_id, title)
+        conversation_id = await async_db.create_conversation(current_user_id, title)
         if not conversation_id:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -246,45 +559,473 @@ async def chat(
             )
     else:
         # Verify the conversation belongs to the user
-        conversation = database.get_conversation_by_id(conversation_id, current_user_id)
+        conversation = await async_db.get_conversation_by_id(conversation_id, current_user_id)
         if not conversation:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Conversation not found"
             )
     
-    # Get existing messages for this conversation
-    existing_messages = database.get_conversation_messages(conversation_id)
+    return conversation_id
+
+def chat_system_prompt(message: str) -> str:
+    """System prompt grounded in a few catalog titles relevant to the message."""
+    hint = catalog.prompt_hint(message)
+    return f"{SYSTEM_PROMPT}\n\n{hint}" if hint else SYSTEM_PROMPT
+
+async def prepare_chat(chat_data: ChatMessage, current_user_id: int) -> Tuple[int, Dict]:
+    """Resolve the conversation for a chat turn and build its token-budgeted context."""
+    conversation_id = await resolve_conversation(chat_data, current_user_id)
     
-    # Prepare messages for Groq API (include system message)
-    api_messages = [
-        {"role": "system", "content": "You are a Anime Expert and will help the user find the best anime for them. Be enthusiastic about anime and provide detailed recommendations with explanations."}
-    ]
+    # System prompt, rolling summary and the recent messages that fit the budget
+    chat_context = await context.build_context(conversation_id, chat_system_prompt(chat_data.message), chat_data.message)
     
-    # Add existing messages
-    for msg in existing_messages:
-        api_messages.append({"role": msg["role"], "content": msg["content"]})
+    return conversation_id, chat_context
+
+def response_cache_key(chat_data: ChatMessage, chat_context: Dict) -> Optional[str]:
+    """Cache key for this turn's completion, or None when caching is off for it."""
+    if not (LLM_CACHE_ENABLED and chat_data.use_cache):
+        return None
+    return completion_key(chat_context["messages"])
+
+def schedule_summary_refresh(background_tasks: BackgroundTasks, conversation_id: int, chat_context: Dict):
+    """Fold messages that fell out of the context window into the summary after responding."""
+    if chat_context["pending"]:
+        background_tasks.add_task(
+            context.refresh_summary,
+            conversation_id,
+            chat_context["summary"],
+            chat_context["pending"],
+            summarize_messages,
+        )
+
+def context_stats(chat_context: Dict) -> Dict:
+    """Token accounting reported back to the client."""
+    return {
+        "prompt_tokens": chat_context["prompt_tokens"],
+        "tokens_saved": chat_context["tokens_saved"],
+    }
+
+@app.post("/chat")
+async def chat(
+    chat_data: ChatMessage,
+    background_tasks: BackgroundTasks,
+    current_user_id: int = Depends(ratelimit.chat_user)
+):
+    """Send a message and get AI response."""
+    conversation_id, chat_context = await prepare_chat(chat_data, current_user_id)
     
-    # Add the new user message
-    api_messages.append({"role": "user", "content": chat_data.message})
+    # Get AI response, from the response cache when possible
+    cache_key = response_cache_key(chat_data, chat_context)
+    ai_response = await response_cache.get(cache_key) if cache_key else None
+    cached = ai_response is not None
+    route: Dict = {}
+    if not cached:
+        ai_response = await query_groq_api(chat_context["messages"], user_key=str(current_user_id), route=route)
+        if cache_key:
+            await response_cache.set(cache_key, ai_response)
     
-    # Get AI response
-    ai_response = query_groq_api(api_messages)
+    # Save both messages to database in one transaction
+    await save_turn(conversation_id, chat_data.message, ai_response)
     
-    # Save both messages to database
-    database.add_message(conversation_id, "user", chat_data.message)
-    database.add_message(conversation_id, "assistant", ai_response)
+    schedule_summary_refresh(background_tasks, conversation_id, chat_context)
     
     return {
         "response": ai_response,
-        "conversation_id": conversation_id
+        "conversation_id": conversation_id,
+        "cached": cached,
+        "backend": route.get("backend"),
+        "context": context_stats(chat_context)
     }
 
+async def iter_cached(response: str) -> AsyncIterator[str]:
+    """Replay a cached response as a single stream delta."""
+    yield response
+
+def sse_event(event: str, data: Dict) -> str:
+    """Format a single Server-Sent Events frame."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream(
+    chat_data: ChatMessage,
+    background_tasks: BackgroundTasks,
+    current_user_id: int = Depends(ratelimit.chat_user)
+):
+    """Send a message and stream the AI response token by token (Server-Sent Events).
+    
+    Emits a `start` event with the conversation id, one `token` event per delta,
+    then `done` with timings (or `error`). If the client disconnects mid-stream
+    the partial response is still saved.
+    """
+    conversation_id, chat_context = await prepare_chat(chat_data, current_user_id)
+    schedule_summary_refresh(background_tasks, conversation_id, chat_context)
+    cache_key = response_cache_key(chat_data, chat_context)
+    cached_response = await response_cache.get(cache_key) if cache_key else None
+    
+    async def event_stream() -> AsyncIterator[str]:
+        start_time = time.time()
+        time_to_first_token = None
+        parts: List[str] = []
+        finished = False
+        failed = False
+        route: Dict = {}
+        
+        try:
+            yield sse_event("start", {"conversation_id": conversation_id})
+            
+            if cached_response is not None:
+                deltas = iter_cached(cached_response)
+            else:
+                deltas = stream_completion(chat_context["messages"], user_key=str(current_user_id), route=route)
+            
+            async for delta in deltas:
+                if time_to_first_token is None:
+                    time_to_first_token = time.time() - start_time
+                parts.append(delta)
+                yield sse_event("token", {"content": delta})
+            
+            finished = True
+            if cache_key and cached_response is None:
+                await response_cache.set(cache_key, "".join(parts))
+            total_time = time.time() - start_time
+            
+            yield sse_event("done", {
+                "conversation_id": conversation_id,
+                "time_to_first_token": time_to_first_token,
+                "total_time": total_time,
+                "cached": cached_response is not None,
+                "backend": route.get("backend"),
+                "context": context_stats(chat_context),
+            })
+        except Exception as e:
+            failed = True
+            error = llm_http_error(e)
+            yield sse_event("error", {
+                "detail": error.detail,
+                "status_code": error.status_code,
+                "retry_after": (error.headers or {}).get("Retry-After"),
+            })
+        finally:
+            # Persist the turn once the stream ends; a client disconnect
+            # (cancellation) still saves whatever was generated so far.
+            if finished or (parts and not failed):
+                with anyio.CancelScope(shield=True):
+                    await save_turn(conversation_id, chat_data.message, "".join(parts))
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=background_tasks,
+    )
+
+# WebSocket chat
+WS_AUTH_TIMEOUT_SECONDS = float(os.getenv("WS_AUTH_TIMEOUT_SECONDS", "10"))
+# Sockets with no client message for this long are closed
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "300"))
+# A client that cannot take a single frame within this long is disconnected
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10"))
+
+WS_POLICY_VIOLATION = 1008
+
+ws_stats = {"open": 0, "turns": 0, "coalesced_tokens": 0, "idle_closed": 0, "slow_closed": 0}
+
+class SlowConsumer(Exception):
+    """The client stopped reading from its socket."""
+
+async def ws_send(websocket: WebSocket, data: Dict):
+    try:
+        await asyncio.wait_for(websocket.send_json(data), WS_SEND_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise SlowConsumer()
+
+async def ws_close(websocket: WebSocket, code: int, reason: str):
+    """Close a socket without waiting on a client that no longer reads."""
+    try:
+        await asyncio.wait_for(websocket.close(code=code, reason=reason), WS_SEND_TIMEOUT_SECONDS)
+    except Exception:
+        pass
+
+class ChatSession:
+    """State of one authenticated chat socket.
+    
+    The open conversation's summary and unsummarized messages are loaded once
+    and then kept up to date as turns are saved, so later turns build their
+    context without touching the database.
+    """
+    
+    def __init__(self, user_id: int, expires_at: float):
+        self.user_id = user_id
+        self.expires_at = expires_at
+        self.conversation_id: Optional[int] = None
+        self.summary: Optional[Dict] = None
+        self.history: List[Dict] = []
+        self.stale = True
+    
+    def expired(self) -> bool:
+        return time.time() >= self.expires_at
+    
+    async def prepare(self, chat_data: ChatMessage) -> Dict:
+        """Switch to the turn's conversation if needed and build its context."""
+        if self.stale or chat_data.conversation_id is None or chat_data.conversation_id != self.conversation_id:
+            self.conversation_id = await resolve_conversation(chat_data, self.user_id)
+            if chat_data.conversation_id is None:
+                self.summary, self.history = None, []
+            else:
+                self.summary, self.history = await context.load_history(self.conversation_id)
+            self.stale = False
+        return context.assemble_context(chat_system_prompt(chat_data.message), self.summary, self.history, chat_data.message)
+    
+    def remember(self, conversation_id: int, ids: Optional[Tuple[int, int]], user_content: str, assistant_content: str):
+        """Append a saved turn to the cached history."""
+        if conversation_id != self.conversation_id:
+            return
+        if ids is None:
+            # Not written yet (DB_WRITE_MODE=async) or failed; reload next turn
+            self.stale = True
+            return
+        self.history.append({"id": ids[0], "role": "user", "content": user_content})
+        self.history.append({"id": ids[1], "role": "assistant", "content": assistant_content})
+    
+    async def refresh_summary(self, conversation_id: int, chat_context: Dict):
+        """Update the stored summary, then drop the messages it now covers from the cache."""
+        await context.refresh_summary(conversation_id, chat_context["summary"], chat_context["pending"], summarize_messages)
+        summary = await async_db.get_conversation_summary(conversation_id)
+        if summary and conversation_id == self.conversation_id:
+            self.summary = summary
+            self.history = [msg for msg in self.history if msg["id"] > summary["summarized_through"]]
+    
+    async def turn(self, websocket: WebSocket, chat_data: ChatMessage):
+        """Answer one chat message, streaming the reply over the socket.
+        
+        The completion is read by a separate task while this one sends. When
+        the client reads slower than tokens arrive, the deltas that piled up
+        are sent as one frame instead of queueing a frame per delta.
+        """
+        chat_context = await self.prepare(chat_data)
+        conversation_id = self.conversation_id
+        cache_key = response_cache_key(chat_data, chat_context)
+        cached_response = await response_cache.get(cache_key) if cache_key else None
+        ws_stats["turns"] += 1
+        
+        start_time = time.time()
+        time_to_first_token = None
+        parts: List[str] = []
+        finished = False
+        failed = False
+        route: Dict = {}
+        arrived = asyncio.Event()
+        
+        async def read_completion():
+            if cached_response is not None:
+                deltas = iter_cached(cached_response)
+            else:
+                deltas = stream_completion(chat_context["messages"], user_key=str(self.user_id), route=route)
+            try:
+                async for delta in deltas:
+                    parts.append(delta)
+                    arrived.set()
+            finally:
+                arrived.set()
+        
+        reader = asyncio.create_task(read_completion())
+        try:
+            await ws_send(websocket, {"type": "start", "conversation_id": conversation_id})
+            sent = 0
+            while not reader.done() or sent < len(parts):
+                await arrived.wait()
+                arrived.clear()
+                if sent < len(parts):
+                    if time_to_first_token is None:
+                        time_to_first_token = time.time() - start_time
+                    ws_stats["coalesced_tokens"] += len(parts) - sent - 1
+                    chunk = "".join(parts[sent:])
+                    sent = len(parts)
+                    await ws_send(websocket, {"type": "token", "content": chunk})
+            try:
+                reader.result()
+            except Exception as e:
+                failed = True
+                error = llm_http_error(e)
+                await ws_send(websocket, {
+                    "type": "error",
+                    "detail": error.detail,
+                    "status_code": error.status_code,
+                    "retry_after": (error.headers or {}).get("Retry-After"),
+                })
+                return
+            
+            finished = True
+            if cache_key and cached_response is None:
+                await response_cache.set(cache_key, "".join(parts))
+            
+            await ws_send(websocket, {
+                "type": "done",
+                "conversation_id": conversation_id,
+                "time_to_first_token": time_to_first_token,
+                "total_time": time.time() - start_time,
+                "cached": cached_response is not None,
+                "backend": route.get("backend"),
+                "context": context_stats(chat_context),
+            })
+        finally:
+            # The client went away mid-reply: stop reading the completion
+            reader.cancel()
+            # Same rule as /chat/stream: keep partial replies, not failed ones
+            if finished or (parts and not failed):
+                response = "".join(parts)
+                with anyio.CancelScope(shield=True):
+                    ids = await save_turn(conversation_id, chat_data.message, response)
+                self.remember(conversation_id, ids, chat_data.message, response)
+            if chat_context["pending"]:
+                task = asyncio.create_task(self.refresh_summary(conversation_id, chat_context))
+                _summary_tasks.add(task)
+                task.add_done_callback(_summary_tasks.discard)
+
+# Summary refreshes outlive the socket that started them
+_summary_tasks = set()
+
+async def ws_receive(websocket: WebSocket, timeout: float) -> Optional[Dict]:
+    """Next JSON object from the client, or None if the message was not one."""
+    message = await asyncio.wait_for(websocket.receive(), timeout)
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    try:
+        data = json.loads(message.get("text") or message.get("bytes") or "")
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+async def ws_authenticate(websocket: WebSocket) -> Optional[ChatSession]:
+    """Verify the token from the socket's first message (or its `token` query parameter)."""
+    token = websocket.query_params.get("token")
+    if token is None:
+        try:
+            message = await ws_receive(websocket, WS_AUTH_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            return None
+        if message and message.get("type") == "auth" and isinstance(message.get("token"), str):
+            token = message["token"]
+    if not token:
+        return None
+    with metrics.stage_timer("auth"):
+        payload = auth.verify_token(token)
+    if payload is None or payload.get("sub") is None:
+        return None
+    return ChatSession(int(payload["sub"]), payload["exp"])
+
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket):
+    """Chat over a persistent WebSocket.
+    
+    The client authenticates once, with `{"type": "auth", "token": ...}` as its
+    first message (or a `token` query parameter), and gets `ready` back. Each
+    `{"type": "chat", "message": ..., "conversation_id": ...}` is then answered
+    with the same `start` / `token` / `done` (or `error`) events as
+    /chat/stream, one turn at a time. `{"type": "ping"}` gets a `pong`. The
+    socket is closed when the token expires or after WS_IDLE_TIMEOUT_SECONDS
+    without a message.
+    """
+    await websocket.accept()
+    ws_stats["open"] += 1
+    try:
+        session = await ws_authenticate(websocket)
+        if session is None:
+            await ws_close(websocket, WS_POLICY_VIOLATION, "Could not validate credentials")
+            return
+        await ws_send(websocket, {"type": "ready", "user_id": session.user_id})
+        
+        while True:
+            try:
+                message = await ws_receive(websocket, WS_IDLE_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                ws_stats["idle_closed"] += 1
+                await ws_close(websocket, 1000, "Idle timeout")
+                return
+            if session.expired():
+                await ws_close(websocket, WS_POLICY_VIOLATION, "Token expired")
+                return
+            
+            kind = message.get("type") if message else None
+            if kind == "ping":
+                await ws_send(websocket, {"type": "pong"})
+                continue
+            if kind != "chat":
+                await ws_send(websocket, {"type": "error", "detail": "Expected a chat, ping or auth message", "status_code": 400})
+                continue
+            try:
+                chat_data = ChatMessage.model_validate(message)
+            except ValidationError as e:
+                await ws_send(websocket, {"type": "error", "detail": e.errors(include_url=False), "status_code": 422})
+                continue
+            
+            try:
+                await ratelimit.check_chat_limits(session.user_id)
+                await session.turn(websocket, chat_data)
+            except HTTPException as e:
+                await ws_send(websocket, {
+                    "type": "error",
+                    "detail": e.detail,
+                    "status_code": e.status_code,
+                    "retry_after": (e.headers or {}).get("Retry-After"),
+                })
+    except SlowConsumer:
+        ws_stats["slow_closed"] += 1
+        await ws_close(websocket, WS_POLICY_VIOLATION, "Client is not reading")
+    except WebSocketDisconnect:
+        pass
+    finally:
+        ws_stats["open"] -= 1
+
+def component_metrics():
+    """Cache, pool and queue statistics exported as gauges on /metrics."""
+    yield from metrics.stats_samples("llm_cache", response_cache.stats())
+    yield from metrics.stats_samples("llm_singleflight", llm_flights.stats())
+    yield from metrics.stats_samples("llm_scheduler", llm_scheduler.stats())
+    yield from metrics.stats_samples("llm_upstream", retry_stats)
+    yield from metrics.stats_samples("llm_router", llm_router.stats())
+    for backend in llm_router.backends:
+        yield from metrics.stats_samples("llm_backend", backend.stats(), {"backend": backend.name})
+    yield from metrics.stats_samples("turn_writer", turn_writer.stats())
+    yield from metrics.stats_samples("websocket", ws_stats)
+    yield from metrics.stats_samples("http_responses", responses.stats())
+    yield from metrics.stats_samples("rate_limit", ratelimit.chat_limiter.stats(), {"limit": "chat"})
+    yield from metrics.stats_samples("rate_limit", ratelimit.auth_limiter.stats(), {"limit": "auth"})
+    yield from metrics.stats_samples("llm_usage", ratelimit.llm_usage.stats())
+    yield from metrics.stats_samples("password_hasher", auth.password_hasher_stats())
+    for pool_stats in database.get_pool_stats():
+        yield from metrics.stats_samples("db_pool", pool_stats, {"database": pool_stats["database"]})
+
+metrics.register_collector(component_metrics)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Health check endpoint
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "database_pools": database.get_pool_stats(),
+        "llm_cache": response_cache.stats(),
+        "llm_flights": llm_flights.stats(),
+        "llm_scheduler": llm_scheduler.stats(),
+        "llm_router": {
+            **llm_router.stats(),
+            "backends": {backend.name: backend.stats() for backend in llm_router.backends},
+        },
+        "turn_writer": turn_writer.stats(),
+        "websockets": ws_stats,
+        "http_responses": responses.stats(),
+        "rate_limits": ratelimit.stats(),
+        "password_hasher": auth.password_hasher_stats(),
+        "catalog": catalog.stats(),
+    }
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,81 @@
+"""Cold storage for idle conversations.
+
+Conversations not updated (or reopened) for ARCHIVE_IDLE_DAYS have their
+messages moved out of the database into one gzip-compressed NDJSON file per
+conversation under ARCHIVE_DIR/<user_id>/. The conversation row stays as a
+stub (archived_at is set) so it still shows up in the conversation list, and
+database.get_conversation_by_id() moves the messages back on first access.
+Archived messages are not full-text searchable until then.
+
+The files use the `message` records of the history export format, so an
+export can stream them as they are. The database work lives in
+database.archive_idle_conversations() / rehydrate_conversation(); run
+`python archive.py` to archive once from the command line.
+"""
+import gzip
+import json
+import os
+from typing import Dict, Iterator, List
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# 0 disables the background archiver
+ARCHIVE_IDLE_DAYS = float(os.getenv("ARCHIVE_IDLE_DAYS", "365"))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+# Conversations archived per database call
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "100"))
+
+def archive_path(user_id: int, conversation_id: int) -> str:
+    return os.path.join(ARCHIVE_DIR, str(user_id), f"{conversation_id}.ndjson.gz")
+
+def write_archive(user_id: int, conversation_id: int, messages: List[Dict]):
+    """Durably write a conversation's messages (replacing any earlier archive)."""
+    path = archive_path(user_id, conversation_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as f:
+            for message in messages:
+                f.write(json.dumps({"type": "message", "conversation_id": conversation_id, **message}).encode("utf-8"))
+                f.write(b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(temp_path, path)
+
+def iter_archive_lines(user_id: int, conversation_id: int) -> Iterator[str]:
+    """Yield the NDJSON lines of an archived conversation."""
+    with gzip.open(archive_path(user_id, conversation_id), "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield line if line.endswith("\n") else line + "\n"
+
+def read_archive(user_id: int, conversation_id: int) -> List[Dict]:
+    """Load an archived conversation's messages in order."""
+    return [json.loads(line) for line in iter_archive_lines(user_id, conversation_id)]
+
+def remove_archive(user_id: int, conversation_id: int):
+    """Delete a conversation's archive file if there is one."""
+    try:
+        os.remove(archive_path(user_id, conversation_id))
+    except FileNotFoundError:
+        pass
+
+if __name__ == "__main__":
+    import argparse
+
+    import database
+
+    parser = argparse.ArgumentParser(description="Archive idle conversations out of the main database.")
+    parser.add_argument("--idle-days", type=float, default=ARCHIVE_IDLE_DAYS)
+    parser.add_argument("--vacuum", action="store_true", help="shrink the database file afterwards")
+    args = parser.parse_args()
+
+    database.initialize_database()
+    total = 0
+    while True:
+        archived = database.archive_idle_conversations(args.idle_days)
+        total += archived
+        if archived < ARCHIVE_BATCH_SIZE:
+            break
+    print(f"Archived {total} conversations to {ARCHIVE_DIR}")
+    if args.vacuum:
+        database.vacuum_database()
@@ -0,0 +1,77 @@
+"""Non-blocking access to the database module for async request handlers.
+
+Every public function in database.py is available here as a coroutine with the
+same name and signature. Calls run on a bounded thread pool so SQLite I/O never
+blocks the event loop:
+
+    user = await async_db.get_user_by_id(user_id)
+"""
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+import anyio
+
+import database
+import metrics
+
+DB_THREADS = int(os.getenv("DB_THREADS", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+READ_PREFIXES = ("get_", "search_", "export_")
+
+async def run(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking callable on the database thread pool."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    finally:
+        stage = "db_read" if getattr(func, "__name__", "").startswith(READ_PREFIXES) else "db_write"
+        metrics.observe_stage(stage, time.perf_counter() - start)
+
+async def iterate(iterator: Iterator[Any]) -> AsyncIterator[Any]:
+    """Consume a blocking iterator (e.g. database.export_user_history) on the thread pool.
+    
+    Each step runs on a pool thread; if the consumer stops early, the iterator
+    is closed once any step still running has finished.
+    """
+    done = object()
+    step: Optional[Future] = None
+    try:
+        while True:
+            start = time.perf_counter()
+            step = _executor.submit(next, iterator, done)
+            item = await asyncio.wrap_future(step)
+            step = None
+            metrics.observe_stage("db_read", time.perf_counter() - start)
+            if item is done:
+                return
+            yield item
+    finally:
+        with anyio.CancelScope(shield=True):
+            if step is not None and not step.cancel():
+                await asyncio.wait([asyncio.wrap_future(step)])
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                await asyncio.wrap_future(_executor.submit(close))
+
+def __getattr__(name: str):
+    func = getattr(database, name, None)
+    if name.startswith("_") or not callable(func):
+        raise AttributeError(f"module 'async_db' has no attribute '{name}'")
+    
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    
+    globals()[name] = wrapper
+    return wrapper
+
+def shutdown():
+    """Wait for queued database work and stop the thread pool."""
+    _executor.shutdown(wait=True)
@@ -1,19 +1,40 @@
 import os
+import asyncio
+import hashlib
+import multiprocessing
+import threading
+import time
 import jwt
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import Optional
+from typing import Optional, Tuple
+
+import metrics
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt is CPU-bound, so the async helpers run it in worker processes.
+# At most PASSWORD_HASH_CONCURRENCY hashes run at once; the rest wait in line.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_CONCURRENCY = int(os.getenv("PASSWORD_HASH_CONCURRENCY", str(PASSWORD_HASH_WORKERS)))
 
 # JWT settings
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Verified-token cache: skips re-decoding and HMAC-verifying a token on every
+# request. Entries are keyed by the token's SHA-256 and never outlive its exp.
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+_token_cache: "OrderedDict[bytes, dict]" = OrderedDict()
+_token_cache_lock = threading.Lock()
+
 security = HTTPBearer()
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -24,6 +45,79 @@ def get_password_hash(password: str) -> str:
     """Hash a password."""
     return pwd_context.hash(password)
 
+def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Verify a password and return a new hash if the stored one uses outdated settings."""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+_hash_pool: Optional[ProcessPoolExecutor] = None
+_hash_semaphore: Optional[asyncio.Semaphore] = None
+_hash_stats = {"waiting": 0, "running": 0, "completed": 0, "rehashed": 0}
+
+def start_hash_pool():
+    """Create the password hashing pool; called at startup.
+    
+    Workers come from a forkserver rather than fork(): by the time the pool
+    starts, the server process runs other threads (database executor, group
+    commit writer) whose held locks a forked child would inherit and deadlock on.
+    """
+    global _hash_pool, _hash_semaphore
+    if _hash_pool is None:
+        _hash_pool = ProcessPoolExecutor(
+            max_workers=PASSWORD_HASH_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+        _hash_semaphore = asyncio.Semaphore(PASSWORD_HASH_CONCURRENCY)
+
+async def _run_in_hash_pool(func, *args):
+    if _hash_pool is None:
+        start_hash_pool()
+    
+    _hash_stats["waiting"] += 1
+    try:
+        await _hash_semaphore.acquire()
+    finally:
+        _hash_stats["waiting"] -= 1
+    
+    _hash_stats["running"] += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_hash_pool, func, *args)
+    finally:
+        _hash_stats["running"] -= 1
+        _hash_stats["completed"] += 1
+        _hash_semaphore.release()
+
+async def hash_password_async(password: str) -> str:
+    """Hash a password without blocking the event loop."""
+    return await _run_in_hash_pool(get_password_hash, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Verify a password without blocking the event loop.
+    
+    Returns (valid, new_hash); new_hash is set when the stored hash should be
+    replaced, e.g. after BCRYPT_ROUNDS changed.
+    """
+    valid, new_hash = await _run_in_hash_pool(verify_and_update_password, plain_password, hashed_password)
+    if new_hash:
+        _hash_stats["rehashed"] += 1
+    return valid, new_hash
+
+def password_hasher_stats() -> dict:
+    """Queue depth and throughput of the password hashing pool."""
+    return {
+        "workers": PASSWORD_HASH_WORKERS,
+        "concurrency": PASSWORD_HASH_CONCURRENCY,
+        "bcrypt_rounds": BCRYPT_ROUNDS,
+        **_hash_stats,
+    }
+
+def shutdown_hash_pool():
+    """Stop the password hashing worker processes."""
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown(wait=True)
+        _hash_pool = None
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create a JWT access token."""
     to_encode = data.copy()
@@ -37,17 +131,43 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 def verify_token(token: str) -> Optional[dict]:
-    """Verify and decode a JWT token."""
+    """Verify and decode a JWT token.
+    
+    Returns a new dict on every call, so callers may modify it without
+    affecting the cached payload.
+    """
+    if TOKEN_CACHE_SIZE > 0:
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        with _token_cache_lock:
+            payload = _token_cache.get(digest)
+            if payload is not None:
+                if payload["exp"] > time.time():
+                    _token_cache.move_to_end(digest)
+                    return dict(payload)
+                del _token_cache[digest]
+    
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
     except jwt.PyJWTError:
         return None
+    
+    if TOKEN_CACHE_SIZE > 0 and isinstance(payload.get("exp"), (int, float)):
+        with _token_cache_lock:
+            _token_cache[digest] = dict(payload)
+            while len(_token_cache) > TOKEN_CACHE_SIZE:
+                _token_cache.popitem(last=False)
+    return payload
+
+def clear_token_cache():
+    """Forget every verified token."""
+    with _token_cache_lock:
+        _token_cache.clear()
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get current user from JWT token."""
     token = credentials.credentials
-    payload = verify_token(token)
+    with metrics.stage_timer("auth"):
+        payload = verify_token(token)
     if payload is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
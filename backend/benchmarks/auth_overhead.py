@@ -0,0 +1,58 @@
+"""Microbenchmark: per-request auth overhead with and without the caches.
+
+Measures what an authenticated request pays before the handler body runs
+(get_current_user) plus the user lookup done by /auth/me (get_user_by_id),
+first with the verified-token and user-record caches disabled, then enabled.
+
+    python benchmarks/auth_overhead.py --iterations 20000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.security import HTTPAuthorizationCredentials
+
+import auth
+import database
+
+def measure(iterations: int, credentials: HTTPAuthorizationCredentials) -> float:
+    """Average microseconds per get_current_user + get_user_by_id."""
+    async def run():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            user_id = await auth.get_current_user(credentials)
+            database.get_user_by_id(user_id)
+        return time.perf_counter() - start
+    return asyncio.run(run()) / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE_FILE = os.path.join(tmp, "bench.db")
+        database.initialize_database()
+        user_id = database.create_user("bench", "bench@example.com", "not-a-real-hash")
+        token = auth.create_access_token(data={"sub": str(user_id), "username": "bench"})
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+        
+        token_cache_size, user_cache_size = auth.TOKEN_CACHE_SIZE, database.USER_CACHE_SIZE
+        auth.TOKEN_CACHE_SIZE = database.USER_CACHE_SIZE = 0
+        uncached = measure(args.iterations, credentials)
+        
+        auth.TOKEN_CACHE_SIZE, database.USER_CACHE_SIZE = token_cache_size, user_cache_size
+        cached = measure(args.iterations, credentials)
+        database.close_pools()
+    
+    print(f"auth overhead per request ({args.iterations} iterations)")
+    print(f"  without caches: {uncached:8.1f} us")
+    print(f"  with caches:    {cached:8.1f} us ({uncached / cached:.1f}x faster)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Load test: concurrent /chat requests must not serialize on the event loop.
+
+Runs the FastAPI app in-process against a fake Groq client that takes a fixed
+time to stream its reply, fires N concurrent /chat requests and probes /health
+while they are in flight. With a non-blocking request path the wall time stays
+close to a single completion and /health answers immediately.
+
+    python benchmarks/concurrent_chat.py --concurrency 20 --latency 1.0
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+# One user fires every request: measure the server, not the rate limiter
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+
+import httpx
+
+import app as app_module
+import database
+
+class FakeCompletions:
+    """Stand-in for AsyncGroq().chat.completions that streams a canned reply."""
+    
+    def __init__(self, latency: float, chunks: int = 10):
+        self.latency = latency
+        self.chunks = chunks
+    
+    async def create(self, **kwargs):
+        async def stream():
+            for i in range(self.chunks):
+                await asyncio.sleep(self.latency / self.chunks)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=f"token{i} "))])
+        return stream()
+
+async def run(concurrency: int, latency: float):
+    for backend in app_module.llm_router.backends:
+        backend.client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions(latency)))
+    database.initialize_database()
+    
+    transport = httpx.ASGITransport(app=app_module.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        await client.post("/auth/register", json={"username": "bench", "email": "bench@example.com", "password": "bench"})
+        login = await client.post("/auth/login", json={"username": "bench", "password": "bench"})
+        headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+        
+        async def chat(i):
+            response = await client.post("/chat", json={"message": f"recommend anime #{i}"}, headers=headers)
+            response.raise_for_status()
+        
+        async def probe_health():
+            await asyncio.sleep(latency / 4)
+            start = time.perf_counter()
+            await client.get("/health")
+            return time.perf_counter() - start
+        
+        start = time.perf_counter()
+        results = await asyncio.gather(probe_health(), *(chat(i) for i in range(concurrency)))
+        wall_time = time.perf_counter() - start
+    
+    print(f"{concurrency} concurrent /chat requests, {latency:.2f}s upstream latency each")
+    print(f"  wall time:          {wall_time:.2f}s (fully serialized would be {concurrency * latency:.2f}s)")
+    print(f"  /health under load: {results[0] * 1000:.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=1.0, help="simulated upstream completion time in seconds")
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE_FILE = os.path.join(tmp, "bench.db")
+        asyncio.run(run(args.concurrency, args.latency))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Local stand-in for the Groq chat-completions API.
+
+Speaks the OpenAI-compatible protocol the groq SDK uses
+(POST /openai/v1/chat/completions, streamed or not), so the backend can be run
+against it by setting GROQ_BASE_URL=http://127.0.0.1:<port>.
+
+Behaviour is configured through environment variables:
+
+    FAKE_GROQ_LATENCY            seconds before the first token (default 0.2)
+    FAKE_GROQ_TOKENS_PER_SECOND  generation speed (default 250)
+    FAKE_GROQ_COMPLETION_TOKENS  tokens per reply, capped by max_tokens (default 200)
+    FAKE_GROQ_ERROR_RATE         fraction of requests failing with 429/500 (default 0)
+    FAKE_GROQ_SEED               random seed for reproducible error sequences
+
+    python benchmarks/fake_groq.py --port 8100
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY = float(os.getenv("FAKE_GROQ_LATENCY", "0.2"))
+TOKENS_PER_SECOND = float(os.getenv("FAKE_GROQ_TOKENS_PER_SECOND", "250"))
+COMPLETION_TOKENS = int(os.getenv("FAKE_GROQ_COMPLETION_TOKENS", "200"))
+ERROR_RATE = float(os.getenv("FAKE_GROQ_ERROR_RATE", "0"))
+
+WORDS = (
+    "Attack on Titan Fullmetal Alchemist Brotherhood Steins;Gate Mob Psycho 100 Cowboy Bebop "
+    "Vinland Saga Frieren is a great pick because of its worldbuilding characters and pacing"
+).split()
+
+rng = random.Random(int(os.getenv("FAKE_GROQ_SEED", "0")))
+app = FastAPI(title="Fake Groq API")
+stats = {"requests": 0, "errors": 0, "completion_tokens": 0}
+
+def prompt_tokens(messages) -> int:
+    return sum(len(message.get("content") or "") for message in messages) // 4
+
+def chunk(completion_id: str, model: str, delta: dict, finish_reason=None, usage=None) -> str:
+    body = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    if usage:
+        body["x_groq"] = {"id": completion_id, "usage": usage}
+    return f"data: {json.dumps(body)}\n\n"
+
+@app.post("/openai/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+
+    if rng.random() < ERROR_RATE:
+        stats["errors"] += 1
+        if rng.random() < 0.5:
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after": "1"},
+            )
+        return JSONResponse({"error": {"message": "Internal server error", "type": "internal_server_error"}}, status_code=500)
+
+    model = body.get("model", "fake")
+    n_tokens = min(COMPLETION_TOKENS, body.get("max_tokens") or COMPLETION_TOKENS)
+    tokens = [rng.choice(WORDS) + " " for _ in range(n_tokens)]
+    usage = {
+        "prompt_tokens": prompt_tokens(body.get("messages", [])),
+        "completion_tokens": n_tokens,
+        "total_tokens": prompt_tokens(body.get("messages", [])) + n_tokens,
+    }
+    stats["completion_tokens"] += n_tokens
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+    if not body.get("stream"):
+        await asyncio.sleep(LATENCY + n_tokens / TOKENS_PER_SECOND)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    async def stream():
+        await asyncio.sleep(LATENCY)
+        yield chunk(completion_id, model, {"role": "assistant", "content": ""})
+        # Emit in ~20 ms batches so sleeps stay coarse at high token rates
+        batch = max(1, int(TOKENS_PER_SECOND * 0.02))
+        for start in range(0, len(tokens), batch):
+            await asyncio.sleep(batch / TOKENS_PER_SECOND)
+            for token in tokens[start:start + batch]:
+                yield chunk(completion_id, model, {"content": token})
+        yield chunk(completion_id, model, {}, finish_reason="stop", usage=usage)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
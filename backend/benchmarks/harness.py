@@ -0,0 +1,316 @@
+"""Reproducible load-test harness for the chatbot API.
+
+Starts a fake Groq server (fake_groq.py) and the real app under uvicorn on
+local ports with a throwaway database, then drives scripted scenarios at each
+requested concurrency level over real HTTP:
+
+    auth_storm    register + login of fresh users (bcrypt bound)
+    sidebar       GET /conversations + GET /conversations/{id} for users with history
+    chat_session  multi-turn POST /chat conversations with growing history
+    chat_stream   POST /chat/stream, recording time-to-first-token
+
+Reports p50/p95/p99 latency, throughput and database size, and writes the
+results as JSON so runs can be compared between commits:
+
+    python benchmarks/harness.py --concurrency 1,8,32
+    python benchmarks/harness.py --compare benchmarks/results/<earlier>.json
+
+Extra environment (e.g. DB_WRITE_MODE=group) is passed through to the app;
+FAKE_GROQ_* variables configure the fake upstream.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+sys.path.insert(0, BACKEND_DIR)
+
+PROMPTS = [
+    "Recommend me something like Attack on Titan",
+    "I loved Fullmetal Alchemist, what should I watch next?",
+    "Any short comedy anime for a weekend?",
+    "What are the best psychological thrillers?",
+    "Something cozy and slice of life please",
+]
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+class Recorder:
+    """Collects per-operation latencies and errors for one scenario run."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, operation: str, seconds: float, ok: bool = True):
+        if ok:
+            self.latencies.setdefault(operation, []).append(seconds)
+        else:
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    async def timed(self, operation: str, request) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await request
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            response, ok = None, False
+        self.record(operation, time.perf_counter() - start, ok)
+        return response if ok else None
+
+    def summary(self, wall_time: float) -> Dict[str, Dict]:
+        operations = {}
+        for operation in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies.get(operation, []))
+            operations[operation] = {
+                "count": len(values),
+                "errors": self.errors.get(operation, 0),
+                "throughput_rps": len(values) / wall_time if wall_time else 0.0,
+                "mean_ms": sum(values) / len(values) * 1000 if values else 0.0,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+            }
+        return operations
+
+async def new_user(client: httpx.AsyncClient, recorder: Optional[Recorder] = None) -> Dict[str, str]:
+    """Register and log in a fresh user; returns auth headers."""
+    name = f"bench_{uuid.uuid4().hex[:12]}"
+    credentials = {"username": name, "password": "benchmark-password"}
+    register = client.post("/auth/register", json={**credentials, "email": f"{name}@example.com"})
+    login = lambda: client.post("/auth/login", json=credentials)
+    if recorder:
+        await recorder.timed("register", register)
+        response = await recorder.timed("login", login())
+    else:
+        await register
+        response = await login()
+    if response is None or response.status_code != 200:
+        return {}
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+async def scenario_auth_storm(client, recorder, worker, args):
+    for _ in range(args.iterations):
+        await new_user(client, recorder)
+
+async def scenario_sidebar(client, recorder, worker, args):
+    headers = await new_user(client)
+    # Seed history directly in the database; the app only reads it here
+    import database
+    user_id = (await client.get("/auth/me", headers=headers)).json()["id"]
+    conversation_ids = [database.create_conversation(user_id, f"Seeded chat {i}") for i in range(args.seed_conversations)]
+    for conversation_id in conversation_ids:
+        database.add_turns([(conversation_id, PROMPTS[i % len(PROMPTS)], "Seeded reply " * 50) for i in range(args.seed_turns)])
+
+    for i in range(args.iterations):
+        await recorder.timed("list_conversations", client.get("/conversations", headers=headers))
+        conversation_id = conversation_ids[i % len(conversation_ids)]
+        await recorder.timed("get_conversation", client.get(f"/conversations/{conversation_id}", headers=headers))
+
+async def scenario_chat_session(client, recorder, worker, args):
+    headers = await new_user(client)
+    conversation_id = None
+    for turn in range(args.iterations):
+        body = {"message": f"{PROMPTS[(worker + turn) % len(PROMPTS)]} (turn {turn})", "conversation_id": conversation_id}
+        response = await recorder.timed("chat", client.post("/chat", json=body, headers=headers))
+        if response is not None:
+            conversation_id = response.json()["conversation_id"]
+
+async def scenario_chat_stream(client, recorder, worker, args):
+    headers = await new_user(client)
+    conversation_id = None
+    for turn in range(args.iterations):
+        body = {"message": f"{PROMPTS[(worker + turn) % len(PROMPTS)]} (stream {turn})", "conversation_id": conversation_id}
+        start = time.perf_counter()
+        first_token = None
+        ok = False
+        try:
+            async with client.stream("POST", "/chat/stream", json=body, headers=headers) as response:
+                event = None
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[7:]
+                    elif line.startswith("data: ") and event == "token" and first_token is None:
+                        first_token = time.perf_counter() - start
+                    elif line.startswith("data: ") and event == "done":
+                        ok = True
+                        conversation_id = json.loads(line[6:])["conversation_id"]
+        except httpx.HTTPError:
+            pass
+        if first_token is not None:
+            recorder.record("chat_stream_ttft", first_token)
+        recorder.record("chat_stream_total", time.perf_counter() - start, ok)
+
+SCENARIOS = {
+    "auth_storm": scenario_auth_storm,
+    "sidebar": scenario_sidebar,
+    "chat_session": scenario_chat_session,
+    "chat_stream": scenario_chat_stream,
+}
+
+async def run_scenario(base_url: str, name: str, concurrency: int, args) -> Dict:
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(SCENARIOS[name](client, recorder, worker, args) for worker in range(concurrency)))
+        wall_time = time.perf_counter() - start
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "wall_time_s": wall_time,
+        "operations": recorder.summary(wall_time),
+    }
+
+def start_process(command: List[str], env: Dict[str, str], log_path: str) -> subprocess.Popen:
+    log = open(log_path, "w")
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def wait_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"Service at {url} did not become ready")
+
+def database_size(path: str) -> int:
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal", "-shm") if os.path.exists(path + suffix))
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_report(results: Dict):
+    print(f"\n{'scenario':<14}{'conc':>5}  {'operation':<20}{'count':>7}{'err':>5}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for run in results["runs"]:
+        for operation, stats in run["operations"].items():
+            print(
+                f"{run['scenario']:<14}{run['concurrency']:>5}  {operation:<20}{stats['count']:>7}{stats['errors']:>5}"
+                f"{stats['throughput_rps']:>9.1f}{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+            )
+    print(f"\ndatabase size: {results['database_bytes'] / 1024:.1f} KiB")
+
+def print_comparison(results: Dict, baseline: Dict):
+    """Show p95 changes against an earlier result file."""
+    def index(data):
+        return {
+            (run["scenario"], run["concurrency"], operation): stats
+            for run in data["runs"] for operation, stats in run["operations"].items()
+        }
+    old, new = index(baseline), index(results)
+    print(f"\ncompared with {baseline['meta'].get('commit')} ({baseline['meta'].get('timestamp')}):")
+    for key in sorted(set(old) & set(new)):
+        before, after = old[key]["p95_ms"], new[key]["p95_ms"]
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"  {key[0]:<14}{key[1]:>5}  {key[2]:<20} p95 {before:9.1f} -> {after:9.1f} ms ({change:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--iterations", type=int, default=10, help="operations (or chat turns) per worker")
+    parser.add_argument("--seed-conversations", type=int, default=20, help="conversations per sidebar user")
+    parser.add_argument("--seed-turns", type=int, default=25, help="turns per seeded conversation")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", default=None, help="result file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_file = os.path.join(tmp, "bench.db")
+        fake_port, app_port = free_port(), free_port()
+        env = {
+            "RATE_LIMIT_ENABLED": "0",
+            **os.environ,
+            "GROQ_API_KEY": "benchmark",
+            "GROQ_BASE_URL": f"http://127.0.0.1:{fake_port}",
+            "DATABASE_FILE": database_file,
+        }
+        os.environ["DATABASE_FILE"] = database_file
+
+        fake = start_process([sys.executable, "benchmarks/fake_groq.py", "--port", str(fake_port)], env, os.path.join(tmp, "fake_groq.log"))
+        server = start_process(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(app_port), "--workers", str(args.workers), "--log-level", "warning"],
+            env,
+            os.path.join(tmp, "app.log"),
+        )
+        try:
+            wait_ready(f"http://127.0.0.1:{fake_port}/stats")
+            wait_ready(f"http://127.0.0.1:{app_port}/health")
+
+            import database
+            database.DATABASE_FILE = database_file
+
+            runs = []
+            for concurrency in levels:
+                for name in scenarios:
+                    print(f"running {name} at concurrency {concurrency}...")
+                    runs.append(asyncio.run(run_scenario(f"http://127.0.0.1:{app_port}", name, concurrency, args)))
+            upstream = httpx.get(f"http://127.0.0.1:{fake_port}/stats").json()
+            size = database_size(database_file)
+            database.close_pools()
+        finally:
+            for process in (server, fake):
+                process.terminate()
+                process.wait(timeout=10)
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "args": vars(args),
+            "fake_groq": {key: value for key, value in os.environ.items() if key.startswith("FAKE_GROQ_")},
+            "app_env": {key: value for key, value in os.environ.items() if key.startswith(("DB_", "LLM_", "CONTEXT_", "BCRYPT_", "RATE_LIMIT_"))},
+        },
+        "runs": runs,
+        "upstream": upstream,
+        "database_bytes": size,
+    }
+    print_report(results)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{results['meta']['commit'] or 'nogit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Benchmark: message compression space savings and read/write overhead.
+
+Writes the same synthetic chat history (markdown recommendation replies built
+from the bundled catalog) into a fresh database once per codec, then reports
+stored content bytes, database file size, turn write time and full-history
+read time through database.get_conversation_messages.
+
+    python benchmarks/message_compression.py --conversations 200 --turns 10
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compression
+import database
+from catalog import CATALOG_FILE
+
+INTROS = [
+    "Great choice! If you enjoyed that, here are a few shows I think you'll love:",
+    "Absolutely! Based on what you've told me, these anime should be right up your alley:",
+    "Ooh, I love this question! Here are some recommendations with a similar vibe:",
+]
+OUTROS = [
+    "Let me know which one catches your eye and I can suggest more like it!",
+    "Happy watching! Tell me what you think and I'll tailor the next batch.",
+]
+
+def synthetic_reply(entries, rng: random.Random) -> str:
+    """A markdown recommendation reply of a few catalog titles."""
+    picks = rng.sample(entries, rng.randint(3, 5))
+    lines = [rng.choice(INTROS), ""]
+    for i, entry in enumerate(picks, 1):
+        lines.append(f"{i}. **{entry['title']}** ({entry['year']})")
+        lines.append(f"   - **Genres:** {', '.join(entry['genres'])}")
+        lines.append(f"   - **Why you'll love it:** {entry['synopsis']} It leans into {', '.join(entry['tags'][:3])}.")
+        lines.append("")
+    lines.append(rng.choice(OUTROS))
+    return "\n".join(lines)
+
+def run(mode: str, directory: str, conversations: int, turns: int, seed: int):
+    compression.MESSAGE_COMPRESSION = mode
+    compression._active = None
+    database.DATABASE_FILE = os.path.join(directory, f"{mode}.db")
+    database.initialize_database()
+
+    with open(CATALOG_FILE, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    rng = random.Random(seed)
+    user_id = database.create_user(f"bench-{mode}", f"bench-{mode}@example.com", "x")
+    conversation_ids = [database.create_conversation(user_id, f"Chat {i}") for i in range(conversations)]
+
+    raw_bytes = 0
+    write_time = 0.0
+    for turn in range(turns):
+        batch = []
+        for conversation_id in conversation_ids:
+            question = f"Can you recommend something like {rng.choice(entries)['title']}?"
+            reply = synthetic_reply(entries, rng)
+            raw_bytes += len(question.encode("utf-8")) + len(reply.encode("utf-8"))
+            batch.append((conversation_id, question, reply))
+        start = time.perf_counter()
+        for conversation_id, question, reply in batch:
+            database.add_turn(conversation_id, question, reply)
+        write_time += time.perf_counter() - start
+
+    start = time.perf_counter()
+    for conversation_id in conversation_ids:
+        database.get_conversation_messages(conversation_id)
+    read_time = time.perf_counter() - start
+
+    database.close_pools()
+    conn = sqlite3.connect(database.DATABASE_FILE)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    stored_bytes = conn.execute("SELECT SUM(length(CAST(content AS BLOB))) FROM messages").fetchone()[0]
+    conn.close()
+    messages = conversations * turns * 2
+    return {
+        "mode": mode,
+        "raw_bytes": raw_bytes,
+        "stored_bytes": stored_bytes,
+        "file_bytes": os.path.getsize(database.DATABASE_FILE),
+        "write_us_per_turn": write_time / (conversations * turns) * 1e6,
+        "read_us_per_message": read_time / messages * 1e6,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    modes = ["off", "zlib"] + (["zstd"] if compression.zstandard is not None else [])
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [run(mode, tmp, args.conversations, args.turns, args.seed) for mode in modes]
+
+    baseline = results[0]
+    print(f"{args.conversations} conversations x {args.turns} turns")
+    print(f"{'codec':<6} {'content':>12} {'ratio':>7} {'db file':>12} {'write/turn':>12} {'read/msg':>10}")
+    for result in results:
+        print(
+            f"{result['mode']:<6} {result['stored_bytes']:>12,} "
+            f"{result['raw_bytes'] / result['stored_bytes']:>6.2f}x {result['file_bytes']:>12,} "
+            f"{result['write_us_per_turn']:>10.1f}us {result['read_us_per_message']:>8.2f}us"
+        )
+    for result in results[1:]:
+        print(
+            f"{result['mode']}: saves {baseline['file_bytes'] - result['file_bytes']:,} bytes on disk "
+            f"({1 - result['file_bytes'] / baseline['file_bytes']:.0%}), "
+            f"write {result['write_us_per_turn'] - baseline['write_us_per_turn']:+.1f}us/turn, "
+            f"read {result['read_us_per_message'] - baseline['read_us_per_message']:+.2f}us/message"
+        )
+
+if __name__ == "__main__":
+    main()
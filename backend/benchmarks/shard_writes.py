@@ -0,0 +1,99 @@
+"""Benchmark: chat turn write throughput versus shard count.
+
+Simulates several uvicorn workers: each writer process saves turns for its
+own slice of users with database.add_turn, all processes at once. With one
+shard every commit queues on the same SQLite write lock; with more shards,
+writers for users on different shards commit in parallel.
+
+    python benchmarks/shard_writes.py --shards 1 2 4 8 --writers 8 --turns 500
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import shards
+
+REPLY = "Here are a few shows you might enjoy, with a short note on why each one fits. " * 12
+
+def configure(database_file: str, shard_count: int, synchronous: str):
+    database.DATABASE_FILE = database_file
+    database.DB_SYNCHRONOUS = synchronous
+    shards.DB_SHARDS = shard_count
+
+def writer(database_file: str, shard_count: int, synchronous: str, conversation_ids, turns: int, start_at: float, results):
+    configure(database_file, shard_count, synchronous)
+    # Warm the pools and owner cache before the clock starts
+    for conversation_id in conversation_ids:
+        database.get_conversation_summary(conversation_id)
+    time.sleep(max(0.0, start_at - time.time()))
+    start = time.perf_counter()
+    failed = 0
+    for turn in range(turns):
+        if database.add_turn(conversation_ids[turn % len(conversation_ids)], f"question {turn}", REPLY) is None:
+            failed += 1
+    results.put((time.perf_counter() - start, failed))
+    database.close_pools()
+
+def run(directory: str, shard_count: int, writers: int, users: int, turns: int, synchronous: str):
+    database_file = os.path.join(directory, f"shards{shard_count}.db")
+    configure(database_file, shard_count, synchronous)
+    database.initialize_database()
+    conversation_ids = [
+        database.create_conversation(database.create_user(f"bench{i}", f"bench{i}@example.com", "x"), "Bench")
+        for i in range(users)
+    ]
+    database.close_pools()
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    start_at = time.time() + 2.0
+    processes = [
+        context.Process(
+            target=writer,
+            args=(database_file, shard_count, synchronous, conversation_ids[i::writers], turns, start_at, results),
+        )
+        for i in range(writers)
+    ]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    wall = max(elapsed for elapsed, _ in outcomes)
+    return {
+        "shards": shard_count,
+        "turns": writers * turns,
+        "failed": sum(failed for _, failed in outcomes),
+        "turns_per_second": writers * turns / wall,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--writers", type=int, default=8, help="writer processes (uvicorn workers)")
+    parser.add_argument("--users", type=int, default=64)
+    parser.add_argument("--turns", type=int, default=500, help="turns saved per writer")
+    parser.add_argument("--synchronous", default="NORMAL", help="PRAGMA synchronous for the writers")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [run(tmp, count, args.writers, args.users, args.turns, args.synchronous) for count in args.shards]
+
+    baseline = results[0]
+    print(f"{args.writers} writers x {args.turns} turns, {args.users} users, synchronous={args.synchronous}")
+    print(f"{'shards':>6} {'turns/s':>10} {'speedup':>8} {'failed':>7}")
+    for result in results:
+        print(
+            f"{result['shards']:>6} {result['turns_per_second']:>10,.0f} "
+            f"{result['turns_per_second'] / baseline['turns_per_second']:>7.2f}x {result['failed']:>7}"
+        )
+
+if __name__ == "__main__":
+    main()
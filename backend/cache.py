@@ -0,0 +1,131 @@
+"""LLM response cache.
+
+Completions are keyed by a hash of the model, the system prompt and the
+normalized message history, so the same question asked in a fresh conversation
+is answered without a Groq round trip. Entries live in an in-memory LRU tier
+and, when LLM_CACHE_PERSIST is enabled, in a SQLite-backed tier that survives
+restarts and is shared between workers. Both tiers evict by size and TTL.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import async_db
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024"))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", "86400"))
+LLM_CACHE_PERSIST = os.getenv("LLM_CACHE_PERSIST", "0") == "1"
+LLM_CACHE_PERSIST_MAX_ENTRIES = int(os.getenv("LLM_CACHE_PERSIST_MAX_ENTRIES", "100000"))
+
+def normalize_content(content: str) -> str:
+    """Normalize message text so trivially different prompts share a key."""
+    return " ".join(content.split()).lower()
+
+def make_key(model: str, messages: List[Dict[str, str]]) -> str:
+    """Cache key for a completion request: model, system prompt and normalized history."""
+    system = [msg["content"] for msg in messages if msg["role"] == "system"]
+    history = [[msg["role"], normalize_content(msg["content"])] for msg in messages if msg["role"] != "system"]
+    payload = json.dumps({"model": model, "system": system, "messages": history}, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """Two-tier (memory LRU + optional SQLite) cache of LLM responses."""
+
+    def __init__(
+        self,
+        max_entries: int = LLM_CACHE_MAX_ENTRIES,
+        ttl_seconds: int = LLM_CACHE_TTL_SECONDS,
+        persist: bool = LLM_CACHE_PERSIST,
+        persist_max_entries: int = LLM_CACHE_PERSIST_MAX_ENTRIES
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist = persist
+        self.persist_max_entries = persist_max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "persistent_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0}
+        self._stores_since_prune = 0
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _get_memory(self, key: str, now: float) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            response, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self._stats["expirations"] += 1
+                return None
+            self._entries.move_to_end(key)
+            return response
+
+    def _set_memory(self, key: str, response: str, expires_at: float):
+        with self._lock:
+            self._entries[key] = (response, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    async def get(self, key: str) -> Optional[str]:
+        """Return the cached response for a key, or None on a miss."""
+        now = time.time()
+        response = self._get_memory(key, now)
+        if response is not None:
+            self._count("memory_hits")
+            return response
+
+        if self.persist:
+            row = await async_db.get_cached_response(key, now)
+            if row:
+                self._set_memory(key, row["response"], row["expires_at"])
+                self._count("persistent_hits")
+                return row["response"]
+
+        self._count("misses")
+        return None
+
+    async def set(self, key: str, response: str):
+        """Store a response in every enabled tier."""
+        if not response:
+            return
+        expires_at = time.time() + self.ttl_seconds
+        self._set_memory(key, response, expires_at)
+        self._count("stores")
+
+        if self.persist:
+            await async_db.store_cached_response(key, response, expires_at)
+            self._stores_since_prune += 1
+            if self._stores_since_prune >= 100:
+                self._stores_since_prune = 0
+                await async_db.prune_response_cache(self.persist_max_entries, time.time())
+
+    def clear(self):
+        """Drop every in-memory entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self._stats["memory_hits"] + self._stats["persistent_hits"] + self._stats["misses"]
+            hits = lookups - self._stats["misses"]
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "persistent": self.persist,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                **self._stats,
+            }
+
+response_cache = ResponseCache()
@@ -0,0 +1,225 @@
+"""Offline anime catalog with vectorized similarity search.
+
+The catalog ships as data/anime_catalog.json. Each title is turned into a
+TF-IDF vector (title, genres, tags and synopsis) and the L2-normalized rows are
+stored as a float32 matrix in CATALOG_INDEX_DIR (a cache directory outside the
+package by default). The index is rebuilt only when the catalog file changes and
+is otherwise memory-mapped, so every worker shares the same pages. Index files
+are written to a temporary file and renamed into place, so workers rebuilding at
+the same time never map a half-written file. Similarity is a single
+matrix-vector product followed by an argpartition top-k.
+"""
+import difflib
+import hashlib
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+CATALOG_FILE = os.getenv("CATALOG_FILE", os.path.join(DATA_DIR, "anime_catalog.json"))
+CACHE_DIR = os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+CATALOG_INDEX_DIR = os.getenv("CATALOG_INDEX_DIR", os.path.join(CACHE_DIR, "anime-haven", "catalog-index"))
+# Candidate titles injected into the chat prompt (0 disables injection)
+CATALOG_PROMPT_CANDIDATES = int(os.getenv("CATALOG_PROMPT_CANDIDATES", "5"))
+CATALOG_MIN_SCORE = float(os.getenv("CATALOG_MIN_SCORE", "0.12"))
+
+# Genres and tags are repeated so they weigh more than incidental synopsis words
+FIELD_WEIGHTS = {"title": 2, "genres": 3, "tags": 2, "synopsis": 1}
+
+STOP_WORDS = frozenset("""
+a an and are as at be but by for from has have he her his i in into is it its
+me my of on or our she so than that the their them they this to was we were
+what when where which who will with would you your about any anime like some
+something similar recommend recommendations show shows watch want more
+""".split())
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens without stop words."""
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in STOP_WORDS]
+
+def normalize_title(title: str) -> str:
+    """Title key that ignores case and punctuation."""
+    return " ".join(re.findall(r"[a-z0-9]+", title.lower()))
+
+def document_tokens(entry: Dict) -> List[str]:
+    """Weighted bag of words for one catalog entry."""
+    tokens = tokenize(entry["title"]) * FIELD_WEIGHTS["title"]
+    tokens += tokenize(" ".join(entry["genres"])) * FIELD_WEIGHTS["genres"]
+    tokens += tokenize(" ".join(entry["tags"])) * FIELD_WEIGHTS["tags"]
+    tokens += tokenize(entry["synopsis"]) * FIELD_WEIGHTS["synopsis"]
+    return tokens
+
+def build_index(entries: List[Dict]):
+    """Compute (vocabulary, idf, matrix) for the catalog."""
+    docs = [Counter(document_tokens(entry)) for entry in entries]
+    vocabulary = sorted(set().union(*docs))
+    column = {term: i for i, term in enumerate(vocabulary)}
+
+    df = np.zeros(len(vocabulary), dtype=np.float32)
+    matrix = np.zeros((len(entries), len(vocabulary)), dtype=np.float32)
+    for row, counts in enumerate(docs):
+        for term, tf in counts.items():
+            matrix[row, column[term]] = 1.0 + math.log(tf)
+            df[column[term]] += 1
+
+    idf = (np.log((1.0 + len(entries)) / (1.0 + df)) + 1.0).astype(np.float32)
+    matrix *= idf
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+    return vocabulary, idf, matrix
+
+def write_atomic(path: str, write):
+    """Write a file via a temporary file in the same directory and rename it into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class Catalog:
+    """Catalog entries plus their memory-mapped TF-IDF matrix."""
+
+    def __init__(self, catalog_file: str = CATALOG_FILE, index_dir: str = CATALOG_INDEX_DIR):
+        self.catalog_file = catalog_file
+        self.index_dir = index_dir
+        self.entries: List[Dict] = []
+        self.matrix: Optional[np.ndarray] = None
+        self.idf: Optional[np.ndarray] = None
+        self._column: Dict[str, int] = {}
+        self._titles: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def load(self):
+        """Load the catalog, rebuilding the on-disk index if the catalog changed."""
+        with self._lock:
+            if self._loaded:
+                return
+            with open(self.catalog_file, "rb") as f:
+                raw = f.read()
+            self.entries = json.loads(raw)
+            source_hash = hashlib.sha256(raw).hexdigest()
+
+            base = os.path.join(self.index_dir, os.path.splitext(os.path.basename(self.catalog_file))[0])
+            meta_file = f"{base}.vocab.json"
+            matrix_file = f"{base}.tfidf.npy"
+            idf_file = f"{base}.idf.npy"
+
+            meta = None
+            if os.path.exists(meta_file) and os.path.exists(matrix_file) and os.path.exists(idf_file):
+                with open(meta_file, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+
+            if not meta or meta.get("source_sha256") != source_hash:
+                vocabulary, idf, matrix = build_index(self.entries)
+                os.makedirs(self.index_dir, exist_ok=True)
+                write_atomic(matrix_file, lambda f: np.save(f, matrix))
+                write_atomic(idf_file, lambda f: np.save(f, idf))
+                # Written last: a matching hash means the arrays are complete
+                meta = {"source_sha256": source_hash, "vocabulary": vocabulary}
+                write_atomic(meta_file, lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+            self.matrix = np.load(matrix_file, mmap_mode="r")
+            self.idf = np.load(idf_file, mmap_mode="r")
+            self._column = {term: i for i, term in enumerate(meta["vocabulary"])}
+            self._titles = {normalize_title(entry["title"]): i for i, entry in enumerate(self.entries)}
+            self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def vectorize(self, text: str) -> np.ndarray:
+        """TF-IDF vector of free text in the catalog's vocabulary."""
+        self._ensure_loaded()
+        vector = np.zeros(len(self._column), dtype=np.float32)
+        for term, tf in Counter(tokenize(text)).items():
+            i = self._column.get(term)
+            if i is not None:
+                vector[i] = 1.0 + math.log(tf)
+        vector *= self.idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def top_k(self, vector: np.ndarray, k: int, exclude: Optional[int] = None, min_score: float = 0.0) -> List[Dict]:
+        """The k entries most similar to a normalized vector, best first."""
+        scores = self.matrix @ vector
+        if exclude is not None:
+            scores[exclude] = -1.0
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [
+            {**self.entries[i], "score": round(float(scores[i]), 4)}
+            for i in best if scores[i] > min_score
+        ]
+
+    def find_title(self, title: str) -> Optional[int]:
+        """Index of the catalog entry best matching a user-supplied title."""
+        self._ensure_loaded()
+        key = normalize_title(title)
+        if not key:
+            return None
+        if key in self._titles:
+            return self._titles[key]
+        prefixed = [name for name in self._titles if name.startswith(key)]
+        if prefixed:
+            return self._titles[min(prefixed, key=len)]
+        close = difflib.get_close_matches(key, list(self._titles), n=1, cutoff=0.6)
+        return self._titles[close[0]] if close else None
+
+    def similar_to(self, title: str, k: int = 5) -> Optional[Dict]:
+        """Titles similar to a catalog title, or None if the title is unknown."""
+        i = self.find_title(title)
+        if i is None:
+            return None
+        return {"match": self.entries[i], "results": self.top_k(np.asarray(self.matrix[i]), k, exclude=i)}
+
+    def search(self, text: str, k: int = 5, min_score: float = CATALOG_MIN_SCORE) -> List[Dict]:
+        """Catalog entries relevant to free text such as a chat message."""
+        vector = self.vectorize(text)
+        if not vector.any():
+            return []
+        return self.top_k(vector, k, min_score=min_score)
+
+    def prompt_hint(self, text: str, k: int = CATALOG_PROMPT_CANDIDATES) -> str:
+        """System prompt block listing catalog candidates for a chat message."""
+        if k <= 0:
+            return ""
+        candidates = self.search(text, k)
+        if not candidates:
+            return ""
+        lines = [
+            f"- {entry['title']} ({entry['year']}; {', '.join(entry['genres'])}): {entry['synopsis']}"
+            for entry in candidates
+        ]
+        return (
+            "Candidate titles from the catalog that may fit this request. "
+            "Prefer them when relevant and keep each explanation to a sentence or two:\n"
+            + "\n".join(lines)
+        )
+
+    def stats(self) -> Dict:
+        """Catalog and index size."""
+        return {
+            "loaded": self._loaded,
+            "titles": len(self.entries),
+            "terms": len(self._column),
+        }
+
+catalog = Catalog()
@@ -0,0 +1,223 @@
+"""Transparent compression of stored message content.
+
+MESSAGE_COMPRESSION selects how new messages are stored:
+
+- "zlib" (default): raw deflate primed with a shared dictionary.
+- "zstd": Zstandard with a trained dictionary (needs the optional
+  `zstandard` package; falls back to zlib without it).
+- "off": store plain text.
+
+Messages shorter than COMPRESSION_MIN_BYTES, or that would not shrink, stay
+plain. messages.codec records how a row is stored: 0 for plain text, otherwise
+the id of the compression_dicts row (algorithm + dictionary) that compressed
+it, so retraining the dictionary never invalidates older rows.
+
+The application's connections get a deterministic `msg_text(codec, content)`
+SQL function (see install()). Full-text snippets and index rebuilds read
+message text through it; plain reads and writes of `messages` do not need it,
+so other tools (the sqlite3 shell, backups) can still open the database.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from catalog import CATALOG_FILE
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+MESSAGE_COMPRESSION = os.getenv("MESSAGE_COMPRESSION", "zlib")
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "256"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+# zlib can only use the last 32 KiB of a dictionary
+COMPRESSION_DICT_SIZE = int(os.getenv("COMPRESSION_DICT_SIZE", str(32 * 1024)))
+COMPRESSION_TRAIN_SAMPLES = int(os.getenv("COMPRESSION_TRAIN_SAMPLES", "2000"))
+# Rows per transaction when compressing messages stored before compression was on
+COMPRESSION_BATCH_SIZE = int(os.getenv("COMPRESSION_BATCH_SIZE", "500"))
+
+if MESSAGE_COMPRESSION not in ("off", "zlib", "zstd"):
+    raise ValueError(f"Invalid MESSAGE_COMPRESSION: {MESSAGE_COMPRESSION}")
+
+if MESSAGE_COMPRESSION == "zstd" and zstandard is None:
+    print("zstandard is not installed; compressing messages with zlib instead")
+    MESSAGE_COMPRESSION = "zlib"
+
+PLAIN = 0
+
+class Codec:
+    """One compression dictionary and the algorithm it belongs to."""
+
+    def __init__(self, codec_id: int, algorithm: str, dictionary: bytes):
+        self.id = codec_id
+        self.algorithm = algorithm
+        self.dictionary = dictionary
+        self._local = threading.local()
+        if algorithm == "zstd":
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read zstd-compressed messages")
+            self._zstd_dict = zstandard.ZstdCompressionDict(dictionary)
+        elif algorithm != "zlib":
+            raise ValueError(f"Unknown compression algorithm: {algorithm}")
+
+    def compress(self, data: bytes) -> bytes:
+        if self.algorithm == "zlib":
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15, zdict=self.dictionary)
+            return compressor.compress(data) + compressor.flush()
+        # zstd (de)compressors are not thread-safe; keep one per thread
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(
+                level=COMPRESSION_LEVEL, dict_data=self._zstd_dict
+            )
+        return compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        if self.algorithm == "zlib":
+            decompressor = zlib.decompressobj(-15, zdict=self.dictionary)
+            return decompressor.decompress(data) + decompressor.flush()
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = self._local.decompressor = zstandard.ZstdDecompressor(dict_data=self._zstd_dict)
+        return decompressor.decompress(data)
+
+_codecs: Dict[int, Codec] = {}
+_codecs_lock = threading.Lock()
+_active: Optional[Codec] = None
+_loader: Optional[Callable[[int], Optional[Tuple[str, bytes]]]] = None
+
+def set_loader(loader: Callable[[int], Optional[Tuple[str, bytes]]]):
+    """Set the function that fetches (algorithm, dictionary) for an unknown codec id."""
+    global _loader
+    _loader = loader
+
+def register(codec_id: int, algorithm: str, dictionary: bytes, active: bool = False) -> Codec:
+    """Make a dictionary available for decoding (and for new writes if `active`)."""
+    global _active
+    codec = Codec(codec_id, algorithm, dictionary)
+    with _codecs_lock:
+        _codecs[codec_id] = codec
+        if active:
+            _active = codec
+    return codec
+
+def active_codec() -> Optional[Codec]:
+    """The codec used for new writes, or None when compression is off."""
+    return _active
+
+def get_codec(codec_id: int) -> Codec:
+    codec = _codecs.get(codec_id)
+    if codec is None:
+        # Trained by another process since we loaded our dictionaries
+        entry = _loader(codec_id) if _loader is not None else None
+        if entry is None:
+            raise KeyError(f"Unknown message codec: {codec_id}")
+        codec = register(codec_id, *entry)
+    return codec
+
+def encode(text: str) -> Tuple[int, Union[str, bytes]]:
+    """Return (codec, stored value) for a message about to be written."""
+    codec = _active
+    if codec is None:
+        return PLAIN, text
+    data = text.encode("utf-8")
+    if len(data) < COMPRESSION_MIN_BYTES:
+        return PLAIN, text
+    compressed = codec.compress(data)
+    if len(compressed) >= len(data):
+        return PLAIN, text
+    return codec.id, compressed
+
+def decode(codec_id: int, content: Union[str, bytes, None]) -> Optional[str]:
+    """Return the text of a stored message."""
+    if not codec_id or content is None:
+        return content
+    return get_codec(codec_id).decompress(content).decode("utf-8")
+
+def install(conn: sqlite3.Connection):
+    """Register the msg_text(codec, content) SQL function on a connection."""
+    conn.create_function("msg_text", 2, decode, deterministic=True)
+
+def seed_samples() -> List[str]:
+    """Recommendation-shaped text built from the anime catalog.
+
+    Used to train the first dictionary before there are stored replies.
+    """
+    try:
+        with open(CATALOG_FILE, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return [
+        f"**{entry['title']}** ({entry['year']})\n"
+        f"- **Genres:** {', '.join(entry['genres'])}\n"
+        f"- **Themes:** {', '.join(entry['tags'])}\n"
+        f"- **Why you'll love it:** {entry['synopsis']}\n"
+        for entry in entries
+    ]
+
+def train_dictionary(samples: List[str], algorithm: str, size: int = COMPRESSION_DICT_SIZE) -> bytes:
+    """Build a shared dictionary from sample messages."""
+    if algorithm == "zstd":
+        data = [sample.encode("utf-8") for sample in samples if sample]
+        try:
+            return zstandard.train_dictionary(size, data).as_bytes()
+        except zstandard.ZstdError:
+            pass  # too few samples to train on; use the zlib-style dictionary
+
+    # Deflate has no dictionary trainer: keep the word sequences that save the
+    # most bytes (frequency x length) and put the best ones last, where their
+    # back-references are shortest.
+    scores: Counter = Counter()
+    for sample in samples:
+        words = re.findall(r"\S+\s*", sample)
+        for n in (1, 2, 3, 4):
+            for i in range(len(words) - n + 1):
+                fragment = "".join(words[i:i + n])
+                if len(fragment) >= 4:
+                    scores[fragment] += 1
+    ranked = sorted(
+        (fragment for fragment, count in scores.items() if count > 1),
+        key=lambda fragment: scores[fragment] * len(fragment),
+        reverse=True,
+    )
+    chosen: List[bytes] = []
+    used = 0
+    for fragment in ranked:
+        encoded = fragment.encode("utf-8")
+        if used + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        used += len(encoded)
+        if used >= size:
+            break
+    return b"".join(reversed(chosen))
+
+if __name__ == "__main__":
+    import argparse
+
+    import database
+    import shards
+
+    parser = argparse.ArgumentParser(description="Manage message compression.")
+    parser.add_argument("--retrain", action="store_true", help="train a new dictionary from recent replies")
+    parser.add_argument("--backfill", action="store_true", help="compress messages stored as plain text")
+    args = parser.parse_args()
+
+    database.initialize_database()
+    if args.retrain:
+        print(f"Active dictionary: {database.train_compression_dictionary()}")
+    if args.backfill:
+        batches = 0
+        for shard in range(shards.DB_SHARDS):
+            last_id = database.compress_message_batch(shard=shard)
+            while last_id is not None:
+                batches += 1
+                last_id = database.compress_message_batch(last_id, shard=shard)
+        print(f"Compressed {batches} batches")
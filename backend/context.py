@@ -0,0 +1,135 @@
+"""Token-budgeted context windows for chat completions.
+
+Instead of replaying the whole conversation on every turn, build_context() sends
+the system prompt, a rolling summary of older turns and as many recent messages
+as fit in CONTEXT_TOKEN_BUDGET. Messages that fall out of the window are folded
+into the summary by refresh_summary() once SUMMARY_BATCH_TOKENS worth of them
+have accumulated, so the summary is updated incrementally rather than rebuilt.
+"""
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import async_db
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+SUMMARY_BATCH_TOKENS = int(os.getenv("SUMMARY_BATCH_TOKENS", "800"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+
+# Per-message framing added by the chat template (role markers etc.)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an anime "
+    "recommendation assistant. Merge the new messages into the current summary. Keep the "
+    "user's tastes, shows they have watched or disliked, and every title already "
+    "recommended. Reply with the updated summary only, in under 200 words."
+)
+
+# Conversations whose summary is currently being refreshed
+_refreshing = set()
+
+def count_tokens(text: str) -> int:
+    """Estimate the number of tokens in a piece of text.
+
+    Uses the ~4 characters per token ratio of Llama-family tokenizers on
+    English text, which is close enough for budgeting without a tokenizer.
+    """
+    return (len(text) + 3) // 4
+
+def message_tokens(message: Dict) -> int:
+    """Estimate the tokens a chat message contributes to the prompt."""
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+async def load_history(conversation_id: int) -> Tuple[Optional[Dict], List[Dict]]:
+    """Load a conversation's rolling summary and the messages it does not cover yet."""
+    summary = await async_db.get_conversation_summary(conversation_id)
+    after_id = summary["summarized_through"] if summary else None
+    history = await async_db.get_conversation_messages(conversation_id, after_id)
+    return summary, history
+
+def assemble_context(
+    system_prompt: str,
+    summary: Optional[Dict],
+    history: List[Dict],
+    new_message: str,
+    budget: int = CONTEXT_TOKEN_BUDGET
+) -> Dict:
+    """Fit the summary and the newest `history` messages into the token budget.
+
+    See build_context() for the returned dict.
+    """
+    head = [{"role": "system", "content": system_prompt}]
+    if summary:
+        head.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary['summary']}"})
+    tail = [{"role": "user", "content": new_message}]
+    used = sum(message_tokens(msg) for msg in head + tail)
+
+    # Keep the newest messages that still fit in the budget
+    cut = len(history)
+    while cut > 0:
+        cost = message_tokens(history[cut - 1])
+        if used + cost > budget:
+            break
+        used += cost
+        cut -= 1
+
+    recent = [{"role": msg["role"], "content": msg["content"]} for msg in history[cut:]]
+    dropped = history[:cut]
+    dropped_tokens = sum(message_tokens(msg) for msg in dropped)
+
+    tokens_saved = dropped_tokens
+    if summary:
+        tokens_saved += summary["summarized_tokens"] - message_tokens(head[-1])
+
+    return {
+        "messages": head + recent + tail,
+        "prompt_tokens": used,
+        "tokens_saved": tokens_saved,
+        "summary": summary,
+        "pending": dropped if dropped_tokens >= SUMMARY_BATCH_TOKENS else [],
+    }
+
+async def build_context(
+    conversation_id: int,
+    system_prompt: str,
+    new_message: str,
+    budget: int = CONTEXT_TOKEN_BUDGET
+) -> Dict:
+    """Build the Groq message list for a new user message.
+
+    Returns a dict with the `messages` to send, the estimated `prompt_tokens`,
+    the `tokens_saved` compared to replaying the full history, and the
+    `summary` / `pending` inputs for refresh_summary().
+    """
+    summary, history = await load_history(conversation_id)
+    return assemble_context(system_prompt, summary, history, new_message, budget)
+
+async def refresh_summary(
+    conversation_id: int,
+    summary: Optional[Dict],
+    pending: List[Dict],
+    summarize: Callable[[List[Dict[str, str]]], Awaitable[str]]
+):
+    """Fold `pending` messages into the conversation's rolling summary.
+
+    `summarize` sends a message list to the LLM and returns its reply. Meant to
+    run as a background task after the response has been sent.
+    """
+    if not pending or conversation_id in _refreshing:
+        return
+
+    _refreshing.add(conversation_id)
+    try:
+        transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in pending)
+        previous = summary["summary"] if summary else "(none yet)"
+        text = await summarize([
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Current summary:\n{previous}\n\nNew messages:\n{transcript}"},
+        ])
+
+        summarized_tokens = (summary["summarized_tokens"] if summary else 0) + sum(message_tokens(msg) for msg in pending)
+        await async_db.save_conversation_summary(conversation_id, text.strip(), pending[-1]["id"], summarized_tokens)
+    except Exception as e:
+        print(f"Error refreshing summary for conversation {conversation_id}: {e}")
+    finally:
+        _refreshing.discard(conversation_id)
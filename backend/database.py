@@ -1,18 +1,76 @@
 import sqlite3
 import os
+import re
 import json
+import threading
+import time
+import weakref
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import Any, Iterator, List, Dict, Optional, Sequence, Tuple
 
-DATABASE_FILE = 'anime_chatbot.db'
+import archive
+import compression
+import shards
+from migrations import DIRECTORY, SCOPES, SHARD, apply_migrations
+
+DATABASE_FILE = os.getenv("DATABASE_FILE", 'anime_chatbot.db')
+
+# Connection pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+
+# get_user_by_id cache. Entries are dropped when the user is updated through
+# this module; the TTL bounds staleness across worker processes.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1024"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+
+# Rows fetched (and NDJSON lines yielded) per step of export_user_history
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "500"))
 
 def initialize_database():
-    """Initialize the database with all required tables."""
+    """Initialize the directory database and every shard with all required tables."""
+    _initialize_file(DATABASE_FILE, _file_scopes(DATABASE_FILE))
+    
+    layout = get_shard_layout()
+    if layout is None and shards.DB_SHARDS > 1 and _has_conversations(DATABASE_FILE):
+        layout = 1  # conversations from before sharding
+    if layout is not None and layout != shards.DB_SHARDS:
+        raise ValueError(
+            f"Conversations are split into {layout} shards but DB_SHARDS is {shards.DB_SHARDS}; "
+            f"run `python shards.py reshard {shards.DB_SHARDS}` first"
+        )
+    if shards.DB_SHARDS > 1:
+        for path in shard_files():
+            _initialize_file(path, (SHARD,))
+        _assign_id_ranges(shard_files())
+    if layout is None:
+        set_shard_layout(shards.DB_SHARDS)
+    
+    load_compression_dictionaries()
+
+def _file_scopes(path: str, count: Optional[int] = None) -> Tuple[str, ...]:
+    """Migration scopes of a file in a layout of `count` shards: the directory file is also the only shard of one."""
+    count = shards.DB_SHARDS if count is None else count
+    if path != DATABASE_FILE:
+        return (SHARD,)
+    return SCOPES if count == 1 else (DIRECTORY,)
+
+def _initialize_file(path: str, scopes: Sequence[str] = SCOPES):
+    """Create the tables of one database file's scopes and bring them to the latest schema."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        compression.install(conn)
         cursor = conn.cursor()
-        print(f"Connected to database: {DATABASE_FILE}")
+        print(f"Connected to database: {path}")
+
+        # WAL lets readers proceed while a writer commits; the setting is
+        # persistent, so pooled connections pick it up automatically.
+        cursor.execute("PRAGMA journal_mode=WAL").fetchone()
 
         # Create users table
         create_users_table = """
@@ -50,11 +108,19 @@ def initialize_database():
         );
         """
 
-        # Execute all table creation statements
-        cursor.executescript(create_users_table + create_conversations_table + create_messages_table)
+        # Execute the table creation statements of this file's scopes
+        script = ""
+        if DIRECTORY in scopes:
+            script += create_users_table
+        if SHARD in scopes:
+            script += create_conversations_table + create_messages_table
+        cursor.executescript(script)
         conn.commit()
         print("Database tables created successfully.")
 
+        version = apply_migrations(conn, scopes)
+        print(f"Database schema at version {version}.")
+
     except sqlite3.Error as e:
         print(f"Database error during initialization: {e}")
         raise
@@ -62,11 +128,215 @@ def initialize_database():
         if conn:
             conn.close()
 
+class PooledConnection(sqlite3.Connection):
+    """A sqlite3 connection whose close() hands it back to its pool."""
+
+    pool = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+    def dispose(self):
+        """Really close the underlying connection."""
+        self.pool = None
+        super().close()
+
+class ConnectionPool:
+    """Per-thread reuse of tuned SQLite connections for one database file.
+
+    Each thread keeps its connection between calls, so the request path stops
+    paying for connect() and pragma setup. Nested acquire() calls on the same
+    thread share the connection; any transaction left open is rolled back when
+    the outermost caller releases it. At most `max_size` connections are kept;
+    beyond that, connections are opened per call and closed on release.
+    """
+
+    def __init__(self, database: str, max_size: int = DB_POOL_SIZE):
+        self.database = database
+        self.max_size = max_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = weakref.WeakSet()
+        self._stats = {"created": 0, "reused": 0, "overflow": 0, "in_use": 0}
+
+    def _connect(self) -> PooledConnection:
+        conn = sqlite3.connect(
+            self.database,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            factory=PooledConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        compression.install(conn)
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.pool = self
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        local = self._local
+        conn = getattr(local, "conn", None)
+        if conn is not None:
+            local.depth += 1
+            with self._lock:
+                self._stats["reused"] += 1
+                if local.depth == 1:
+                    self._stats["in_use"] += 1
+            return conn
+
+        with self._lock:
+            pinned = len(self._connections) < self.max_size
+            self._stats["created"] += 1
+            self._stats["in_use"] += 1
+            if not pinned:
+                self._stats["overflow"] += 1
+
+        conn = self._connect()
+        if pinned:
+            with self._lock:
+                self._connections.add(conn)
+            local.conn = conn
+            local.depth = 1
+        return conn
+
+    def release(self, conn: PooledConnection):
+        local = self._local
+        if getattr(local, "conn", None) is not conn:
+            # Overflow connection, or one released from a foreign thread
+            with self._lock:
+                self._stats["in_use"] -= 1
+            conn.dispose()
+            return
+
+        local.depth -= 1
+        if local.depth > 0:
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._stats["in_use"] -= 1
+
+    def close_all(self):
+        """Close every pooled connection (used at shutdown)."""
+        with self._lock:
+            connections = list(self._connections)
+            self._connections = weakref.WeakSet()
+        for conn in connections:
+            conn.dispose()
+        self._local = threading.local()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "database": self.database,
+                "max_size": self.max_size,
+                "open": len(self._connections),
+                **self._stats,
+            }
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def get_pool(database: Optional[str] = None) -> ConnectionPool:
+    """Get the connection pool for a database file (DATABASE_FILE by default)."""
+    database = database or DATABASE_FILE
+    pool = _pools.get(database)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(database, ConnectionPool(database))
+    return pool
+
+def get_pool_stats() -> List[Dict]:
+    """Usage statistics for every connection pool."""
+    return [pool.stats() for pool in list(_pools.values())]
+
+def close_pools():
+    """Close all pooled connections."""
+    for pool in list(_pools.values()):
+        pool.close_all()
+
 def get_db_connection():
-    """Get a database connection with row factory."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Get a pooled database connection with row factory.
+
+    Callers close() it as before; that returns it to the pool.
+    """
+    return get_pool().acquire()
+
+# Shard routing (see shards.py)
+_owner_cache: "OrderedDict[int, int]" = OrderedDict()
+_owner_cache_lock = threading.Lock()
+
+def shard_file(shard: int, count: Optional[int] = None) -> str:
+    """Database file of a shard in a layout of `count` shards (DB_SHARDS by default)."""
+    return shards.shard_path(DATABASE_FILE, shard, count or shards.DB_SHARDS)
+
+def shard_files(count: Optional[int] = None) -> List[str]:
+    count = count or shards.DB_SHARDS
+    return [shard_file(shard, count) for shard in range(count)]
+
+def get_user_connection(user_id: int):
+    """Get a pooled connection to the shard holding a user's conversations."""
+    return get_pool(shard_file(shards.shard_for_user(user_id, shards.DB_SHARDS))).acquire()
+
+def _remember_owner(conversation_id: int, user_id: int):
+    with _owner_cache_lock:
+        _owner_cache[conversation_id] = user_id
+        _owner_cache.move_to_end(conversation_id)
+        while len(_owner_cache) > shards.SHARD_DIRECTORY_CACHE_SIZE:
+            _owner_cache.popitem(last=False)
+
+def conversation_shard(conversation_id: int) -> int:
+    """The shard holding a conversation, found through the conversation directory.
+    
+    Unknown IDs map to shard 0, where lookups find nothing.
+    """
+    if shards.DB_SHARDS == 1:
+        return 0
+    with _owner_cache_lock:
+        user_id = _owner_cache.get(conversation_id)
+        if user_id is not None:
+            _owner_cache.move_to_end(conversation_id)
+    if user_id is None:
+        conn = get_db_connection()
+        try:
+            row = conn.execute("SELECT user_id FROM conversation_directory WHERE id = ?", (conversation_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return 0
+        user_id = row["user_id"]
+        _remember_owner(conversation_id, user_id)
+    return shards.shard_for_user(user_id, shards.DB_SHARDS)
+
+def get_conversation_connection(conversation_id: int):
+    """Get a pooled connection to the shard holding a conversation."""
+    return get_pool(shard_file(conversation_shard(conversation_id))).acquire()
+
+def _allocate_conversation_id(directory: sqlite3.Connection, user_id: int) -> int:
+    cursor = directory.execute("INSERT INTO conversation_directory (user_id) VALUES (?)", (user_id,))
+    return cursor.lastrowid
+
+def _release_conversation_ids(directory: sqlite3.Connection, conversation_ids: List[int]):
+    """Remove the directory entries of conversations that were deleted or never created.
+    
+    IDs are not reused (AUTOINCREMENT), so a stale cached owner is harmless.
+    """
+    try:
+        directory.executemany(
+            "DELETE FROM conversation_directory WHERE id = ?",
+            [(conversation_id,) for conversation_id in conversation_ids]
+        )
+        directory.commit()
+    except sqlite3.Error as e:
+        directory.rollback()
+        print(f"Error releasing conversation IDs {conversation_ids}: {e}")
+    with _owner_cache_lock:
+        for conversation_id in conversation_ids:
+            _owner_cache.pop(conversation_id, None)
 
 # User management functions
 def create_user(username: str, email: str, password_hash: str) -> Optional[int]:
@@ -88,14 +358,42 @@ def create_user(username: str, email: str, password_hash: str) -> Optional[int]:
     finally:
         conn.close()
 
+_user_cache: "OrderedDict[int, tuple]" = OrderedDict()
+_user_cache_lock = threading.Lock()
+
+def invalidate_user_cache(user_id: Optional[int] = None):
+    """Drop one user's cached record, or every record."""
+    with _user_cache_lock:
+        if user_id is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(user_id, None)
+
 def get_user_by_id(user_id: int) -> Optional[Dict]:
     """Get user by ID."""
+    if USER_CACHE_SIZE > 0:
+        with _user_cache_lock:
+            entry = _user_cache.get(user_id)
+            if entry is not None and entry[1] > time.monotonic():
+                _user_cache.move_to_end(user_id)
+                return dict(entry[0])
+    
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
         cursor.execute("SELECT id, username, email, created_at FROM users WHERE id = ?", (user_id,))
         user = cursor.fetchone()
-        return dict(user) if user else None
+        if not user:
+            return None
+        
+        user = dict(user)
+        if USER_CACHE_SIZE > 0:
+            with _user_cache_lock:
+                _user_cache[user_id] = (user, time.monotonic() + USER_CACHE_TTL_SECONDS)
+                _user_cache.move_to_end(user_id)
+                while len(_user_cache) > USER_CACHE_SIZE:
+                    _user_cache.popitem(last=False)
+        return dict(user)
     except sqlite3.Error as e:
         print(f"Error fetching user: {e}")
         return None
@@ -130,33 +428,78 @@ def get_user_by_email(email: str) -> Optional[Dict]:
     finally:
         conn.close()
 
+def update_user_password_hash(user_id: int, password_hash: str) -> bool:
+    """Replace a user's password hash."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET password_hash = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (password_hash, user_id)
+        )
+        conn.commit()
+        invalidate_user_cache(user_id)
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        print(f"Error updating password hash: {e}")
+        return False
+    finally:
+        conn.close()
+
 # Conversation management functions
 def create_conversation(user_id: int, title: str) -> Optional[int]:
     """Create a new conversation and return its ID."""
-    conn = get_db_connection()
+    directory = get_db_connection()
+    conn = get_user_connection(user_id)
+    conversation_id = None
     try:
+        # With a single shard both are the same connection and one transaction
+        conversation_id = _allocate_conversation_id(directory, user_id)
+        if directory is not conn:
+            directory.commit()
         cursor = conn.cursor()
         cursor.execute(
-            "INSERT INTO conversations (user_id, title) VALUES (?, ?)",
-            (user_id, title)
+            "INSERT INTO conversations (id, user_id, title) VALUES (?, ?, ?)",
+            (conversation_id, user_id, title)
         )
         conn.commit()
-        return cursor.lastrowid
+        _remember_owner(conversation_id, user_id)
+        return conversation_id
     except sqlite3.Error as e:
+        conn.rollback()
+        if directory is not conn:
+            directory.rollback()
+            # The directory entry was already committed: undo it
+            if conversation_id is not None:
+                _release_conversation_ids(directory, [conversation_id])
         print(f"Error creating conversation: {e}")
         return None
     finally:
         conn.close()
+        directory.close()
 
-def get_user_conversations(user_id: int) -> List[Dict]:
-    """Get all conversations for a user."""
-    conn = get_db_connection()
+def get_user_conversations(user_id: int, before: Optional[Tuple[str, int]] = None, limit: Optional[int] = None) -> List[Dict]:
+    """Get conversations for a user, most recently updated first.
+    
+    Keyset pagination: with `before`, an (updated_at, id) position, only
+    conversations that sort after it are returned; `limit` caps the page size.
+    """
+    conn = get_user_connection(user_id)
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, title, created_at, updated_at FROM conversations WHERE user_id = ? ORDER BY updated_at DESC",
-            (user_id,)
-        )
+        if before is None:
+            cursor.execute(
+                "SELECT id, title, created_at, updated_at, archived_at FROM conversations WHERE user_id = ? "
+                "ORDER BY updated_at DESC, id DESC LIMIT ?",
+                (user_id, limit if limit is not None else -1)
+            )
+        else:
+            cursor.execute(
+                "SELECT id, title, created_at, updated_at, archived_at FROM conversations WHERE user_id = ? "
+                "AND (updated_at, id) < (?, ?) "
+                "ORDER BY updated_at DESC, id DESC LIMIT ?",
+                (user_id, before[0], before[1], limit if limit is not None else -1)
+            )
         conversations = cursor.fetchall()
         return [dict(conv) for conv in conversations]
     except sqlite3.Error as e:
@@ -166,25 +509,57 @@ def get_user_conversations(user_id: int) -> List[Dict]:
         conn.close()
 
 def get_conversation_by_id(conversation_id: int, user_id: int) -> Optional[Dict]:
-    """Get a specific conversation by ID (ensuring user ownership)."""
-    conn = get_db_connection()
+    """Get a specific conversation by ID (ensuring user ownership).
+    
+    An archived conversation is rehydrated into the database first.
+    """
+    conn = get_user_connection(user_id)
     try:
         cursor = conn.cursor()
         cursor.execute(
-            "SELECT id, title, created_at, updated_at FROM conversations WHERE id = ? AND user_id = ?",
+            "SELECT id, title, created_at, updated_at, archived_at FROM conversations WHERE id = ? AND user_id = ?",
             (conversation_id, user_id)
         )
         conversation = cursor.fetchone()
-        return dict(conversation) if conversation else None
     except sqlite3.Error as e:
         print(f"Error fetching conversation: {e}")
         return None
     finally:
         conn.close()
+    
+    if not conversation:
+        return None
+    conversation = dict(conversation)
+    if conversation["archived_at"] is not None:
+        if not rehydrate_conversation(conversation_id, user_id):
+            return None
+        conversation["archived_at"] = None
+    return conversation
+
+def get_conversation_version(conversation_id: int, user_id: int) -> Optional[Dict]:
+    """Get the fields a conversation's ETag is derived from, without loading messages."""
+    conn = get_user_connection(user_id)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT c.id, c.title, c.updated_at, c.archived_at,
+                   (SELECT MAX(id) FROM messages WHERE conversation_id = c.id) AS last_message_id
+            FROM conversations c WHERE c.id = ? AND c.user_id = ?
+            """,
+            (conversation_id, user_id)
+        )
+        version = cursor.fetchone()
+        return dict(version) if version else None
+    except sqlite3.Error as e:
+        print(f"Error fetching conversation version: {e}")
+        return None
+    finally:
+        conn.close()
 
 def update_conversation_title(conversation_id: int, user_id: int, title: str) -> bool:
     """Update conversation title."""
-    conn = get_db_connection()
+    conn = get_user_connection(user_id)
     try:
         cursor = conn.cursor()
         cursor.execute(
@@ -201,70 +576,1007 @@ def update_conversation_title(conversation_id: int, user_id: int, title: str) ->
 
 def delete_conversation(conversation_id: int, user_id: int) -> bool:
     """Delete a conversation and all its messages."""
-    conn = get_db_connection()
+    directory = get_db_connection()
+    conn = get_user_connection(user_id)
     try:
         cursor = conn.cursor()
         cursor.execute(
             "DELETE FROM conversations WHERE id = ? AND user_id = ?",
             (conversation_id, user_id)
         )
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return False
+        _delete_conversation_messages(cursor, conversation_id, user_id)
+        cursor.execute("DELETE FROM conversation_summaries WHERE conversation_id = ?", (conversation_id,))
         conn.commit()
-        return cursor.rowcount > 0
+        # Only once the conversation is gone, so the directory never misses a live one
+        _release_conversation_ids(directory, [conversation_id])
+        archive.remove_archive(user_id, conversation_id)
+        return True
     except sqlite3.Error as e:
+        conn.rollback()
         print(f"Error deleting conversation: {e}")
         return False
     finally:
         conn.close()
+        directory.close()
+
+# Full-text index maintenance. messages_fts is updated here, next to every
+# write to messages, instead of by triggers (see migration 5). Each row also
+# carries its owner's token (fts_owner()) so searches are scoped to one user
+# inside the index.
+def fts_owner(user_id: int) -> str:
+    return f"u{user_id}"
+
+def _index_messages(cursor: sqlite3.Cursor, user_id: int, rows: List[Tuple[int, str]]):
+    """Add a user's (message_id, text) rows to the full-text index."""
+    owner = fts_owner(user_id)
+    cursor.executemany(
+        "INSERT INTO messages_fts (rowid, content, owner) VALUES (?, ?, ?)",
+        [(message_id, text, owner) for message_id, text in rows]
+    )
+
+def _unindex_messages(cursor: sqlite3.Cursor, user_id: int, rows: List[Tuple[int, str]]):
+    """Remove a user's (message_id, text) rows from the full-text index; the text must be what was indexed."""
+    owner = fts_owner(user_id)
+    cursor.executemany(
+        "INSERT INTO messages_fts (messages_fts, rowid, content, owner) VALUES ('delete', ?, ?, ?)",
+        [(message_id, text, owner) for message_id, text in rows]
+    )
+
+def _delete_conversation_messages(cursor: sqlite3.Cursor, conversation_id: int, user_id: int):
+    cursor.execute("SELECT id, codec, content FROM messages WHERE conversation_id = ?", (conversation_id,))
+    _unindex_messages(cursor, user_id, [(row[0], compression.decode(row[1], row[2])) for row in cursor.fetchall()])
+    cursor.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+
+def _touch_conversation(cursor: sqlite3.Cursor, conversation_id: int) -> int:
+    """Bump a conversation's updated_at and return its owner."""
+    cursor.execute(
+        "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ? RETURNING user_id",
+        (conversation_id,)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        raise sqlite3.IntegrityError(f"conversation {conversation_id} does not exist")
+    return row[0]
 
 # Message management functions
 def add_message(conversation_id: int, role: str, content: str) -> Optional[int]:
     """Add a message to a conversation."""
-    conn = get_db_connection()
+    conn = get_conversation_connection(conversation_id)
     try:
         cursor = conn.cursor()
+        # Update conversation's updated_at timestamp in the same transaction
+        user_id = _touch_conversation(cursor, conversation_id)
+        codec, stored = compression.encode(content)
         cursor.execute(
-            "INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
-            (conversation_id, role, content)
+            "INSERT INTO messages (conversation_id, role, content, codec) VALUES (?, ?, ?, ?)",
+            (conversation_id, role, stored, codec)
         )
+        message_id = cursor.lastrowid
+        _index_messages(cursor, user_id, [(message_id, content)])
         conn.commit()
         
-        # Update conversation's updated_at timestamp
+        return message_id
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"Error adding message: {e}")
+        return None
+    finally:
+        conn.close()
+
+def _insert_turn(cursor: sqlite3.Cursor, conversation_id: int, user_content: str, assistant_content: str) -> Tuple[int, int]:
+    user_id = _touch_conversation(cursor, conversation_id)
+    codec, stored = compression.encode(user_content)
+    cursor.execute(
+        "INSERT INTO messages (conversation_id, role, content, codec) VALUES (?, 'user', ?, ?)",
+        (conversation_id, stored, codec)
+    )
+    user_message_id = cursor.lastrowid
+    codec, stored = compression.encode(assistant_content)
+    cursor.execute(
+        "INSERT INTO messages (conversation_id, role, content, codec) VALUES (?, 'assistant', ?, ?)",
+        (conversation_id, stored, codec)
+    )
+    assistant_message_id = cursor.lastrowid
+    _index_messages(cursor, user_id, [(user_message_id, user_content), (assistant_message_id, assistant_content)])
+    return user_message_id, assistant_message_id
+
+def add_turn(conversation_id: int, user_content: str, assistant_content: str) -> Optional[Tuple[int, int]]:
+    """Add a user message and the assistant reply in one transaction.
+    
+    Returns the (user, assistant) message IDs.
+    """
+    results = add_turns([(conversation_id, user_content, assistant_content)])
+    return results[0] if results else None
+
+def add_turns(turns: List[Tuple[int, str, str]]) -> List[Tuple[int, int]]:
+    """Add several (conversation_id, user_content, assistant_content) turns in one transaction.
+    
+    All turns must be for conversations on the same shard (see
+    conversation_shard()). Returns the message IDs of each turn in order, or
+    an empty list if the transaction failed (nothing is written in that case).
+    """
+    if not turns:
+        return []
+    conn = get_conversation_connection(turns[0][0])
+    try:
+        cursor = conn.cursor()
+        results = [_insert_turn(cursor, *turn) for turn in turns]
+        conn.commit()
+        return results
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"Error adding turns: {e}")
+        return []
+    finally:
+        conn.close()
+
+def get_conversation_messages(
+    conversation_id: int,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = None
+) -> List[Dict]:
+    """Get messages for a conversation in chronological order.
+    
+    `after_id` / `before_id` bound the message IDs (exclusive). With `limit`,
+    the newest `limit` messages in that range are returned. Compressed
+    content is only decoded for the rows returned.
+    """
+    conn = get_conversation_connection(conversation_id)
+    try:
+        cursor = conn.cursor()
+        query = "SELECT id, role, content, codec, timestamp FROM messages WHERE conversation_id = ? AND id > ?"
+        params = [conversation_id, after_id or 0]
+        if before_id is not None:
+            query += " AND id < ?"
+            params.append(before_id)
+        
+        if limit is None:
+            cursor.execute(query + " ORDER BY id ASC", params)
+            messages = cursor.fetchall()
+        else:
+            cursor.execute(query + " ORDER BY id DESC LIMIT ?", params + [limit])
+            messages = cursor.fetchall()[::-1]
+        
+        result = []
+        for msg in messages:
+            msg = dict(msg)
+            codec = msg.pop("codec")
+            if codec:
+                msg["content"] = compression.decode(codec, msg["content"])
+            result.append(msg)
+        return result
+    except sqlite3.Error as e:
+        print(f"Error fetching messages: {e}")
+        return []
+    finally:
+        conn.close()
+
+# Message compression functions
+def _load_compression_dictionary(codec_id: int) -> Optional[Tuple[str, bytes]]:
+    # Runs inside msg_text(), so use a separate connection
+    conn = sqlite3.connect(DATABASE_FILE, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    try:
+        row = conn.execute(
+            "SELECT algorithm, dictionary FROM compression_dicts WHERE id = ?", (codec_id,)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+    finally:
+        conn.close()
+
+compression.set_loader(_load_compression_dictionary)
+
+def load_compression_dictionaries() -> Optional[int]:
+    """Register the stored compression dictionaries and activate one for new writes.
+    
+    A dictionary is trained on first use of an algorithm. Returns the active
+    codec id, or None when compression is off.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, algorithm, dictionary FROM compression_dicts ORDER BY id")
+        active_id = None
+        for row in cursor.fetchall():
+            active = row["algorithm"] == compression.MESSAGE_COMPRESSION
+            try:
+                compression.register(row["id"], row["algorithm"], row["dictionary"], active)
+            except RuntimeError as e:
+                print(f"Skipping compression dictionary {row['id']}: {e}")
+                continue
+            if active:
+                active_id = row["id"]
+    except sqlite3.Error as e:
+        print(f"Error loading compression dictionaries: {e}")
+        return None
+    finally:
+        conn.close()
+    
+    if active_id is None and compression.MESSAGE_COMPRESSION != "off":
+        active_id = train_compression_dictionary()
+    return active_id
+
+def train_compression_dictionary() -> Optional[int]:
+    """Train a dictionary on recent replies (plus catalog seed text) and use it for new writes."""
+    algorithm = compression.MESSAGE_COMPRESSION
+    if algorithm == "off":
+        return None
+    
+    samples = []
+    per_shard = max(1, compression.COMPRESSION_TRAIN_SAMPLES // shards.DB_SHARDS)
+    for path in shard_files():
+        shard = get_pool(path).acquire()
+        try:
+            rows = shard.execute(
+                "SELECT msg_text(codec, content) AS content FROM messages WHERE role = 'assistant' ORDER BY id DESC LIMIT ?",
+                (per_shard,)
+            ).fetchall()
+            samples.extend(row["content"] for row in rows)
+        except sqlite3.Error as e:
+            print(f"Error reading compression samples from {path}: {e}")
+        finally:
+            shard.close()
+    samples += compression.seed_samples()
+    
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        dictionary = compression.train_dictionary(samples, algorithm)
         cursor.execute(
-            "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (conversation_id,)
+            "INSERT INTO compression_dicts (algorithm, dictionary) VALUES (?, ?)",
+            (algorithm, dictionary)
         )
         conn.commit()
-        
+        compression.register(cursor.lastrowid, algorithm, dictionary, active=True)
         return cursor.lastrowid
     except sqlite3.Error as e:
-        print(f"Error adding message: {e}")
+        print(f"Error training compression dictionary: {e}")
         return None
     finally:
         conn.close()
 
-def get_conversation_messages(conversation_id: int) -> List[Dict]:
-    """Get all messages for a conversation."""
-    conn = get_db_connection()
+def compress_message_batch(
+    after_id: int = 0,
+    batch_size: int = compression.COMPRESSION_BATCH_SIZE,
+    shard: int = 0
+) -> Optional[int]:
+    """Compress up to `batch_size` plain messages of a shard with IDs above `after_id`, in one transaction.
+    
+    Returns the last message ID examined (pass it back in for the next batch),
+    or None once there is nothing left to compress on that shard.
+    """
+    if compression.active_codec() is None:
+        return None
+    
+    conn = get_pool(shard_file(shard)).acquire()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, content FROM messages WHERE id > ? AND codec = 0 AND length(content) >= ? ORDER BY id LIMIT ?",
+            (after_id, compression.COMPRESSION_MIN_BYTES, batch_size)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+        
+        updates = []
+        for row in rows:
+            codec, stored = compression.encode(row["content"])
+            if codec:
+                updates.append((stored, codec, row["id"]))
+        cursor.executemany("UPDATE messages SET content = ?, codec = ? WHERE id = ? AND codec = 0", updates)
+        conn.commit()
+        return rows[-1]["id"]
+    except sqlite3.Error as e:
+        print(f"Error compressing messages: {e}")
+        return None
+    finally:
+        conn.close()
+
+# Archive functions
+def archive_idle_conversations(idle_days: float = archive.ARCHIVE_IDLE_DAYS, limit: int = archive.ARCHIVE_BATCH_SIZE) -> int:
+    """Move the messages of up to `limit` idle conversations to archive files.
+    
+    A conversation is idle when neither updated nor rehydrated for
+    `idle_days`. Each one is archived in its own write transaction; the file
+    is written before its messages are deleted. Returns how many were archived.
+    """
+    archived = 0
+    for path in shard_files():
+        if archived >= limit:
+            break
+        archived += _archive_idle_in(path, idle_days, limit - archived)
+    return archived
+
+def _archive_idle_in(path: str, idle_days: float, limit: int) -> int:
+    idle_since = f"-{idle_days} days"
+    conn = get_pool(path).acquire()
+    try:
+        cursor = conn.cursor()
+        idle_query = (
+            "SELECT id, user_id FROM conversations WHERE archived_at IS NULL "
+            "AND updated_at < datetime('now', ?) AND (rehydrated_at IS NULL OR rehydrated_at < datetime('now', ?))"
+        )
+        cursor.execute(idle_query + " ORDER BY updated_at LIMIT ?", (idle_since, idle_since, limit))
+        candidates = cursor.fetchall()
+        
+        archived = 0
+        for candidate in candidates:
+            conversation_id, user_id = candidate["id"], candidate["user_id"]
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # Re-check under the write lock: another worker may have
+                # archived it, or a message may have arrived since
+                cursor.execute(idle_query + " AND id = ?", (idle_since, idle_since, conversation_id))
+                if cursor.fetchone() is None:
+                    conn.rollback()
+                    continue
+                cursor.execute(
+                    "SELECT id, role, content, codec, timestamp FROM messages WHERE conversation_id = ? ORDER BY id",
+                    (conversation_id,)
+                )
+                messages = [
+                    {
+                        "id": row["id"],
+                        "role": row["role"],
+                        "content": compression.decode(row["codec"], row["content"]),
+                        "timestamp": row["timestamp"],
+                    }
+                    for row in cursor.fetchall()
+                ]
+                archive.write_archive(user_id, conversation_id, messages)
+                _unindex_messages(cursor, user_id, [(message["id"], message["content"]) for message in messages])
+                cursor.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+                cursor.execute(
+                    "UPDATE conversations SET archived_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (conversation_id,)
+                )
+                conn.commit()
+                archived += 1
+            except (sqlite3.Error, OSError) as e:
+                conn.rollback()
+                print(f"Error archiving conversation {conversation_id}: {e}")
+        return archived
+    except sqlite3.Error as e:
+        print(f"Error finding idle conversations: {e}")
+        return 0
+    finally:
+        conn.close()
+
+def rehydrate_conversation(conversation_id: int, user_id: int) -> bool:
+    """Move an archived conversation's messages back into the database.
+    
+    Messages keep their original IDs, so pagination cursors and summaries
+    stay valid.
+    """
+    try:
+        messages = archive.read_archive(user_id, conversation_id)
+    except FileNotFoundError:
+        print(f"Archive file missing for conversation {conversation_id}; restoring it empty")
+        messages = []
+    except (OSError, ValueError) as e:
+        print(f"Error reading archive of conversation {conversation_id}: {e}")
+        return False
+    
+    conn = get_user_connection(user_id)
     try:
         cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(
+            "SELECT archived_at FROM conversations WHERE id = ? AND user_id = ?",
+            (conversation_id, user_id)
+        )
+        conversation = cursor.fetchone()
+        if conversation is None:
+            conn.rollback()
+            return False
+        if conversation["archived_at"] is None:
+            conn.rollback()
+            return True  # rehydrated concurrently
+        
+        rows = []
+        for message in messages:
+            codec, stored = compression.encode(message["content"])
+            rows.append((message["id"], conversation_id, message["role"], stored, codec, message["timestamp"]))
+        cursor.executemany(
+            "INSERT INTO messages (id, conversation_id, role, content, codec, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        _index_messages(cursor, user_id, [(message["id"], message["content"]) for message in messages])
         cursor.execute(
-            "SELECT id, role, content, timestamp FROM messages WHERE conversation_id = ? ORDER BY timestamp ASC",
+            "UPDATE conversations SET archived_at = NULL, rehydrated_at = CURRENT_TIMESTAMP WHERE id = ?",
             (conversation_id,)
         )
-        messages = cursor.fetchall()
-        return [dict(msg) for msg in messages]
+        conn.commit()
     except sqlite3.Error as e:
-        print(f"Error fetching messages: {e}")
-        return []
+        conn.rollback()
+        print(f"Error rehydrating conversation {conversation_id}: {e}")
+        return False
+    finally:
+        conn.close()
+    
+    archive.remove_archive(user_id, conversation_id)
+    return True
+
+def vacuum_database():
+    """Rebuild the database files to return space freed by archiving to the OS."""
+    for path in dict.fromkeys([DATABASE_FILE] + shard_files()):
+        conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        try:
+            compression.install(conn)
+            conn.execute("VACUUM")
+        except sqlite3.Error as e:
+            print(f"Error vacuuming {path}: {e}")
+        finally:
+            conn.close()
+
+# Conversation summary functions
+def get_conversation_summary(conversation_id: int) -> Optional[Dict]:
+    """Get the rolling summary of a conversation's older messages."""
+    conn = get_conversation_connection(conversation_id)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT summary, summarized_through, summarized_tokens FROM conversation_summaries WHERE conversation_id = ?",
+            (conversation_id,)
+        )
+        summary = cursor.fetchone()
+        return dict(summary) if summary else None
+    except sqlite3.Error as e:
+        print(f"Error fetching summary: {e}")
+        return None
+    finally:
+        conn.close()
+
+def save_conversation_summary(conversation_id: int, summary: str, summarized_through: int, summarized_tokens: int) -> bool:
+    """Store a conversation summary unless a newer one has already been saved."""
+    conn = get_conversation_connection(conversation_id)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO conversation_summaries (conversation_id, summary, summarized_through, summarized_tokens)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (conversation_id) DO UPDATE SET
+                summary = excluded.summary,
+                summarized_through = excluded.summarized_through,
+                summarized_tokens = excluded.summarized_tokens,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE excluded.summarized_through > conversation_summaries.summarized_through
+            """,
+            (conversation_id, summary, summarized_through, summarized_tokens)
+        )
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        print(f"Error saving summary: {e}")
+        return False
     finally:
         conn.close()
 
-def get_conversation_with_messages(conversation_id: int, user_id: int) -> Optional[Dict]:
-    """Get a conversation with all its messages."""
+def get_conversation_with_messages(
+    conversation_id: int,
+    user_id: int,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = None
+) -> Optional[Dict]:
+    """Get a conversation with its messages (all of them, or a page ending before `before_id`)."""
     conversation = get_conversation_by_id(conversation_id, user_id)
     if not conversation:
         return None
     
-    messages = get_conversation_messages(conversation_id)
+    messages = get_conversation_messages(conversation_id, before_id=before_id, limit=limit)
     conversation['messages'] = messages
-    return conversation 
\ No newline at end of file
+    return conversation
+
+# Search functions
+def fts_query(text: str) -> str:
+    """Turn free text into a safe FTS5 query: all words must match, the last as a prefix."""
+    words = re.findall(r"\w+", text)
+    if not words:
+        return ""
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def search_messages(user_id: int, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+    """Full-text search over a user's messages, best matches first.
+    
+    The owner token restricts the match to the user's rows inside the index,
+    so other users' messages are never read or ranked.
+    """
+    match = fts_query(query)
+    if not match:
+        return []
+    
+    conn = get_user_connection(user_id)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT m.id AS message_id, m.conversation_id, c.title, m.role, m.timestamp,
+                   snippet(messages_fts, 0, '<mark>', '</mark>', '...', 16) AS snippet,
+                   bm25(messages_fts, 1.0, 0.0) AS rank
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE messages_fts MATCH ? AND c.user_id = ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+            """,
+            (f'owner : "{fts_owner(user_id)}" AND content : ({match})', user_id, limit, offset)
+        )
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Error searching messages: {e}")
+        return []
+    finally:
+        conn.close()
+
+# Export and import functions
+EXPORT_FORMAT_VERSION = 1
+
+def export_user_history(user_id: int, batch_rows: int = EXPORT_BATCH_ROWS) -> Iterator[str]:
+    """Yield a user's conversations and messages as NDJSON, `batch_rows` rows at a time.
+    
+    The first line is a header and the last an `end` record with counts; a
+    stream without it was cut short. Each conversation line is followed by
+    its messages. If an archived conversation cannot be read to the end, an
+    `error` record follows the messages read so far, and the `end` record
+    lists the conversation under `incomplete`. Rows are read from one
+    snapshot through a cursor on a dedicated connection and archives are
+    streamed line by line, so memory stays constant and the generator can be
+    resumed from any thread.
+    """
+    path = shard_file(shards.shard_for_user(user_id, shards.DB_SHARDS))
+    conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    compression.install(conn)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        cursor.execute(
+            """
+            SELECT c.id AS conversation_id, c.title, c.created_at, c.updated_at, c.archived_at,
+                   m.id AS message_id, m.role, m.content, m.codec, m.timestamp
+            FROM conversations c
+            LEFT JOIN messages m ON m.conversation_id = c.id
+            WHERE c.user_id = ?
+            ORDER BY c.updated_at DESC, c.id DESC, m.id
+            """,
+            (user_id,)
+        )
+        yield json.dumps({
+            "type": "export",
+            "version": EXPORT_FORMAT_VERSION,
+            "user_id": user_id,
+            "exported_at": datetime.now().isoformat(),
+        }) + "\n"
+        
+        current = None
+        counts = {"conversations": 0, "messages": 0}
+        incomplete = []
+        lines = []
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows:
+                break
+            for row in rows:
+                if row["conversation_id"] != current:
+                    current = row["conversation_id"]
+                    counts["conversations"] += 1
+                    lines.append(json.dumps({
+                        "type": "conversation",
+                        "id": current,
+                        "title": row["title"],
+                        "created_at": row["created_at"],
+                        "updated_at": row["updated_at"],
+                    }))
+                    if row["archived_at"] is not None:
+                        # Streamed like the rows, so a large archive is never held in memory
+                        try:
+                            for line in archive.iter_archive_lines(user_id, current):
+                                counts["messages"] += 1
+                                lines.append(line.rstrip("\n"))
+                                if len(lines) >= batch_rows:
+                                    yield "\n".join(lines) + "\n"
+                                    lines = []
+                        except (OSError, EOFError, ValueError) as e:
+                            print(f"Error reading archive of conversation {current}: {e}")
+                            incomplete.append(current)
+                            lines.append(json.dumps({
+                                "type": "error",
+                                "conversation_id": current,
+                                "detail": "Archived messages could not be read",
+                            }))
+                if row["message_id"] is not None:
+                    counts["messages"] += 1
+                    lines.append(json.dumps({
+                        "type": "message",
+                        "id": row["message_id"],
+                        "conversation_id": current,
+                        "role": row["role"],
+                        "content": compression.decode(row["codec"], row["content"]),
+                        "timestamp": row["timestamp"],
+                    }))
+            if lines:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        
+        yield json.dumps({"type": "end", **counts, "incomplete": incomplete}) + "\n"
+    except sqlite3.Error as e:
+        print(f"Error exporting history: {e}")
+    finally:
+        conn.close()
+
+def import_history_batch(user_id: int, records: List[Dict[str, Any]], conversation_ids: Dict[int, int]) -> Optional[Dict[str, int]]:
+    """Import parsed export records for a user in one transaction.
+    
+    Conversations get new IDs; `conversation_ids` maps exported IDs to them
+    and is updated in place so later batches can add messages to
+    conversations from earlier ones. Returns the number of conversations and
+    messages written, or None if the batch failed (nothing is written then).
+    """
+    directory = get_db_connection()
+    conn = get_user_connection(user_id)
+    allocated: List[int] = []
+    try:
+        # Reserve the conversation IDs first (same transaction with one shard)
+        for record in records:
+            if record["type"] == "conversation":
+                allocated.append(_allocate_conversation_id(directory, user_id))
+        if directory is not conn:
+            directory.commit()
+        
+        cursor = conn.cursor()
+        new_ids: Dict[int, int] = {}
+        messages = []
+        conversations = 0
+        for record in records:
+            if record["type"] == "conversation":
+                cursor.execute(
+                    "INSERT INTO conversations (id, user_id, title, created_at, updated_at) "
+                    "VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))",
+                    (allocated[conversations], user_id, record["title"], record.get("created_at"), record.get("updated_at"))
+                )
+                new_ids[record["id"]] = allocated[conversations]
+                conversations += 1
+            else:
+                conversation_id = new_ids.get(record["conversation_id"]) or conversation_ids.get(record["conversation_id"])
+                if conversation_id is None:
+                    raise ValueError(f"message {record.get('id')} belongs to an unknown conversation")
+                codec, stored = compression.encode(record["content"])
+                cursor.execute(
+                    "INSERT INTO messages (conversation_id, role, content, codec, timestamp) "
+                    "VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))",
+                    (conversation_id, record["role"], stored, codec, record.get("timestamp"))
+                )
+                messages.append((cursor.lastrowid, record["content"]))
+        
+        _index_messages(cursor, user_id, messages)
+        conn.commit()
+        conversation_ids.update(new_ids)
+        for conversation_id in new_ids.values():
+            _remember_owner(conversation_id, user_id)
+        return {"conversations": conversations, "messages": len(messages)}
+    except (sqlite3.Error, ValueError) as e:
+        conn.rollback()
+        if directory is not conn:
+            directory.rollback()
+            if allocated:
+                _release_conversation_ids(directory, allocated)
+        print(f"Error importing history: {e}")
+        return None
+    finally:
+        conn.close()
+        directory.close()
+
+# Sharding functions
+def get_shard_layout() -> Optional[int]:
+    """Number of shards the conversations are split into, or None if not recorded yet."""
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT value FROM shard_layout WHERE key = 'shards'").fetchone()
+        return row["value"] if row else None
+    finally:
+        conn.close()
+
+def set_shard_layout(count: int):
+    conn = get_db_connection()
+    try:
+        conn.execute("INSERT OR REPLACE INTO shard_layout (key, value) VALUES ('shards', ?)", (count,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def _connect_file(path: str) -> sqlite3.Connection:
+    """Unpooled connection for maintenance work on one database file."""
+    conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    compression.install(conn)
+    return conn
+
+def _has_conversations(path: str) -> bool:
+    conn = _connect_file(path)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversations'").fetchone() is None:
+            return False
+        return conn.execute("SELECT EXISTS (SELECT 1 FROM conversations)").fetchone()[0] == 1
+    finally:
+        conn.close()
+
+def _conversation_counts(conn: sqlite3.Connection, schema: str = "main") -> Dict[str, int]:
+    # Messages and summaries of deleted conversations are not counted (or moved)
+    owned = f"conversation_id IN (SELECT id FROM {schema}.conversations)"
+    return {
+        "conversations": conn.execute(f"SELECT COUNT(*) FROM {schema}.conversations").fetchone()[0],
+        "messages": conn.execute(f"SELECT COUNT(*) FROM {schema}.messages WHERE {owned}").fetchone()[0],
+        "summaries": conn.execute(f"SELECT COUNT(*) FROM {schema}.conversation_summaries WHERE {owned}").fetchone()[0],
+    }
+
+def _assign_id_ranges(paths: List[str], existing: Sequence[str] = ()):
+    """Give shard files that have never allocated a message ID a range of their own.
+    
+    New ranges start above every ID allocated in the directory, `paths` and
+    `existing`, so message IDs stay unique when rows move between files.
+    """
+    sequences = {}
+    for path in dict.fromkeys([DATABASE_FILE, *existing, *paths]):
+        conn = _connect_file(path)
+        try:
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+            sequences[path] = row[0] if row else None
+        finally:
+            conn.close()
+    
+    fresh = [path for path in paths if sequences[path] is None]
+    start = shards.id_range_start(max(seq or 0 for seq in sequences.values()))
+    for i, path in enumerate(fresh):
+        conn = _connect_file(path)
+        try:
+            # Workers starting together compute the same start; only one insert wins
+            conn.execute(
+                "INSERT INTO sqlite_sequence (name, seq) SELECT 'messages', ? "
+                "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'messages')",
+                (start + (i << shards.SHARD_ID_BITS),)
+            )
+        finally:
+            conn.close()
+
+def get_shard_stats() -> List[Dict]:
+    """Conversation and message counts of every shard."""
+    stats = []
+    for shard, path in enumerate(shard_files()):
+        conn = _connect_file(path)
+        try:
+            stats.append({"shard": shard, "database": path, **_conversation_counts(conn)})
+        except sqlite3.Error as e:
+            print(f"Error counting rows in {path}: {e}")
+        finally:
+            conn.close()
+    return stats
+
+def _clear_conversations(path: str):
+    conn = _connect_file(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for table in ("conversation_summaries", "messages", "conversations"):
+            conn.execute(f"DELETE FROM {table}")
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')")
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+def _drop_conversation_tables(path: str):
+    """Remove the shard tables from the directory file once its conversations live in other shards."""
+    conn = _connect_file(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DROP TABLE IF EXISTS messages_fts")
+        conn.execute("DROP VIEW IF EXISTS messages_text")
+        for table in ("conversation_summaries", "messages", "conversations"):
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.execute("DELETE FROM schema_migrations WHERE scope = ?", (SHARD,))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+def _remove_database_file(path: str):
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+def reshard_database(target: int) -> Dict[str, int]:
+    """Move every conversation, with its summary and messages, to its shard in a layout of `target` shards.
+    
+    Run with the server stopped. Rows keep their IDs. The new layout is
+    recorded only after the row counts of the copy match the source, and the
+    old copies are removed after that. Returns the number of conversations and
+    messages moved.
+    """
+    if target < 1:
+        raise ValueError(f"Invalid shard count: {target}")
+    _initialize_file(DATABASE_FILE, (DIRECTORY,))
+    current = get_shard_layout() or 1
+    if target == current:
+        return {"conversations": 0, "messages": 0}
+    sources = shard_files(current)
+    targets = shard_files(target)
+    
+    for path in sources:
+        _initialize_file(path, _file_scopes(path, current))
+    # Anything already in the target files is left over from an interrupted run
+    for path in targets:
+        if path == DATABASE_FILE:
+            _initialize_file(path, _file_scopes(path, target))
+            _clear_conversations(path)
+        else:
+            _remove_database_file(path)
+            _initialize_file(path, (SHARD,))
+    _assign_id_ranges(targets, sources)
+    
+    expected = {"conversations": 0, "messages": 0, "summaries": 0}
+    copied = dict(expected)
+    for shard, path in enumerate(targets):
+        conn = _connect_file(path)
+        conn.create_function("shard_of", 1, lambda user_id: shards.shard_for_user(user_id, target), deterministic=True)
+        try:
+            for source in sources:
+                conn.execute("ATTACH DATABASE ? AS source", (source,))
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    owned = "SELECT id FROM source.conversations WHERE shard_of(user_id) = ?"
+                    for table, condition in (
+                        ("conversations", "shard_of(user_id) = ?"),
+                        ("conversation_summaries", f"conversation_id IN ({owned})"),
+                        ("messages", f"conversation_id IN ({owned})"),
+                    ):
+                        columns = ", ".join(row["name"] for row in conn.execute(f"PRAGMA main.table_info({table})"))
+                        conn.execute(
+                            f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM source.{table} WHERE {condition}",
+                            (shard,)
+                        )
+                    conn.execute("COMMIT")
+                except sqlite3.Error:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    raise
+                finally:
+                    conn.execute("DETACH DATABASE source")
+            # The copy bypassed the application's index maintenance
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            for key, count in _conversation_counts(conn).items():
+                copied[key] += count
+        finally:
+            conn.close()
+    
+    for path in sources:
+        conn = _connect_file(path)
+        try:
+            for key, count in _conversation_counts(conn).items():
+                expected[key] += count
+        finally:
+            conn.close()
+    if copied != expected:
+        raise RuntimeError(f"Reshard copied {copied} but the source has {expected}; the layout was not changed")
+    
+    set_shard_layout(target)
+    for path in sources:
+        if path == DATABASE_FILE:
+            _drop_conversation_tables(path)
+        else:
+            _remove_database_file(path)
+    with _owner_cache_lock:
+        _owner_cache.clear()
+    return {"conversations": expected["conversations"], "messages": expected["messages"]}
+
+# LLM response cache functions
+def get_cached_response(key: str, now: float) -> Optional[Dict]:
+    """Get an unexpired cached LLM response and mark it as recently used."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT response, expires_at FROM llm_cache WHERE key = ? AND expires_at > ?",
+            (key, now)
+        )
+        entry = cursor.fetchone()
+        if entry:
+            cursor.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+            conn.commit()
+        return dict(entry) if entry else None
+    except sqlite3.Error as e:
+        print(f"Error reading response cache: {e}")
+        return None
+    finally:
+        conn.close()
+
+def store_cached_response(key: str, response: str, expires_at: float) -> bool:
+    """Insert or replace a cached LLM response."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, response, expires_at, last_used) VALUES (?, ?, ?, ?)",
+            (key, response, expires_at, datetime.now().timestamp())
+        )
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        print(f"Error writing response cache: {e}")
+        return False
+    finally:
+        conn.close()
+
+def prune_response_cache(max_entries: int, now: float) -> int:
+    """Delete expired cache entries and the least recently used ones beyond max_entries."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (now,))
+        removed = cursor.rowcount
+        cursor.execute(
+            """
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (max_entries,)
+        )
+        removed += cursor.rowcount
+        conn.commit()
+        return removed
+    except sqlite3.Error as e:
+        print(f"Error pruning response cache: {e}")
+        return 0
+    finally:
+        conn.close()
+
+# LLM usage quota functions
+def get_llm_usage(user_id: int, day: str) -> int:
+    """Get the LLM tokens a user has used on a day (UTC, YYYY-MM-DD)."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT tokens FROM llm_usage WHERE user_id = ? AND day = ?", (user_id, day))
+        row = cursor.fetchone()
+        return row["tokens"] if row else 0
+    except sqlite3.Error as e:
+        print(f"Error reading LLM usage: {e}")
+        return 0
+    finally:
+        conn.close()
+
+def add_llm_usage(usage: Dict[Tuple[str, int], int]) -> Optional[Dict[Tuple[str, int], int]]:
+    """Add token counts per (day, user_id) in one transaction.
+    
+    Returns the new totals, which include the usage recorded by other
+    workers, or None if nothing was written.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        totals = {}
+        for (day, user_id), tokens in usage.items():
+            cursor.execute(
+                """
+                INSERT INTO llm_usage (user_id, day, tokens) VALUES (?, ?, ?)
+                ON CONFLICT (user_id, day) DO UPDATE SET tokens = tokens + excluded.tokens
+                RETURNING tokens
+                """,
+                (user_id, day, tokens)
+            )
+            totals[(day, user_id)] = cursor.fetchone()["tokens"]
+        conn.commit()
+        return totals
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"Error recording LLM usage: {e}")
+        return None
+    finally:
+        conn.close()
@@ -0,0 +1,125 @@
+"""NDJSON export and import of a user's chat history.
+
+The format is produced by database.export_user_history(): a header line, then
+one `conversation` record followed by its `message` records, then an `end`
+record with counts. An `error` record after a conversation means its archived
+messages could not be read; the `end` record lists those conversations
+under `incomplete`. Imports create new conversations for the target user and
+are written IMPORT_BATCH_ROWS records per transaction.
+
+    python history.py export <username> > history.ndjson
+    python history.py import <username> history.ndjson
+"""
+import json
+import os
+import sys
+from typing import Any, AsyncIterator, Dict, Optional, Set
+
+IMPORT_BATCH_ROWS = int(os.getenv("IMPORT_BATCH_ROWS", "1000"))
+
+ROLES = ("user", "assistant")
+
+def parse_record(line: str, line_number: int, conversations: Set[int]) -> Optional[Dict[str, Any]]:
+    """Validate one line of an export.
+
+    Returns the record to import, or None for blank, header, error and end lines.
+    `conversations` collects the conversation IDs seen so far; messages must
+    follow their conversation. Raises ValueError for malformed lines.
+    """
+    if not line.strip():
+        return None
+    try:
+        record = json.loads(line)
+    except ValueError:
+        raise ValueError(f"line {line_number}: invalid JSON")
+    if not isinstance(record, dict):
+        raise ValueError(f"line {line_number}: expected a JSON object")
+
+    kind = record.get("type")
+    if kind in ("export", "end", "error"):
+        return None
+    if kind == "conversation":
+        if not isinstance(record.get("id"), int) or not isinstance(record.get("title"), str):
+            raise ValueError(f"line {line_number}: conversation needs an integer id and a title")
+        conversations.add(record["id"])
+        return record
+    if kind == "message":
+        if record.get("conversation_id") not in conversations:
+            raise ValueError(f"line {line_number}: message before its conversation")
+        if record.get("role") not in ROLES or not isinstance(record.get("content"), str):
+            raise ValueError(f"line {line_number}: message needs a role of {' or '.join(ROLES)} and content")
+        return record
+    raise ValueError(f"line {line_number}: unknown record type {kind!r}")
+
+async def aiter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a streamed UTF-8 body into lines without buffering all of it."""
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8")
+    if buffer:
+        yield buffer.decode("utf-8")
+
+def main():
+    import argparse
+    import contextlib
+
+    import database
+
+    parser = argparse.ArgumentParser(description="Export or import a user's chat history as NDJSON.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    export_parser = subcommands.add_parser("export", help="write a user's history to stdout")
+    export_parser.add_argument("username")
+    import_parser = subcommands.add_parser("import", help="load an export into a user's account")
+    import_parser.add_argument("username")
+    import_parser.add_argument("file", help="NDJSON file, or - for stdin")
+    args = parser.parse_args()
+
+    # Keep stdout clean for the export itself
+    with contextlib.redirect_stdout(sys.stderr):
+        database.initialize_database()
+    user = database.get_user_by_username(args.username)
+    if not user:
+        sys.exit(f"Unknown user: {args.username}")
+
+    if args.command == "export":
+        for chunk in database.export_user_history(user["id"]):
+            sys.stdout.write(chunk)
+            if chunk.startswith('{"type": "end"'):
+                end = json.loads(chunk)
+                if end["incomplete"]:
+                    print(f"Messages missing for conversations {end['incomplete']} (unreadable archives)", file=sys.stderr)
+        return
+
+    source = sys.stdin if args.file == "-" else open(args.file, "r", encoding="utf-8")
+    conversation_ids: Dict[int, int] = {}
+    seen: Set[int] = set()
+    totals = {"conversations": 0, "messages": 0}
+    batch = []
+
+    def flush():
+        written = database.import_history_batch(user["id"], batch, conversation_ids)
+        if written is None:
+            sys.exit(f"Import failed after {totals['conversations']} conversations and {totals['messages']} messages")
+        for key in totals:
+            totals[key] += written[key]
+        batch.clear()
+
+    with source:
+        for line_number, line in enumerate(source, 1):
+            try:
+                record = parse_record(line, line_number, seen)
+            except ValueError as e:
+                sys.exit(f"Invalid export: {e}")
+            if record is not None:
+                batch.append(record)
+                if len(batch) >= IMPORT_BATCH_ROWS:
+                    flush()
+    if batch:
+        flush()
+    print(f"Imported {totals['conversations']} conversations and {totals['messages']} messages", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""Lightweight Prometheus metrics and per-request stage timing.
+
+Histograms and counters are kept in process and rendered in the Prometheus
+text exposition format by render() (served on /metrics). Recording an
+observation is a bisect plus a few additions under a lock, so instrumenting the
+hot path costs on the order of a microsecond.
+
+Each HTTP request also gets a dict of stage durations (auth, db_read, db_write,
+llm_ttft, llm_total, ...) through a context variable; TimingMiddleware exposes
+it as a Server-Timing response header.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # [per-bucket counts..., +Inf count, sum]
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for labels, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = _format_labels(self.label_names, labels, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+# Request-level metrics
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "HTTP request latency.", ("method", "route", "status"))
+STAGE_SECONDS = Histogram("request_stage_duration_seconds", "Time spent per request stage.", ("stage",))
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens sent to and generated by the LLM.", ("kind",))
+LLM_REQUESTS = Counter("llm_requests_total", "Upstream LLM calls by outcome.", ("outcome",))
+
+_registry = [HTTP_REQUEST_SECONDS, STAGE_SECONDS, LLM_TOKENS, LLM_REQUESTS]
+_collectors: List[Callable[[], Iterable[Tuple[str, Dict[str, str], float]]]] = []
+
+request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("request_timings", default=None)
+
+def observe_stage(stage: str, seconds: float):
+    """Record time spent in a stage, globally and for the current request."""
+    STAGE_SECONDS.observe(seconds, stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+class stage_timer:
+    """Context manager that records the enclosed block as a stage."""
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe_stage(self.stage, time.perf_counter() - self.start)
+        return False
+
+def register_collector(collector: Callable[[], Iterable[Tuple[str, Dict[str, str], float]]]):
+    """Register a callback yielding (gauge name, labels, value) samples at scrape time."""
+    _collectors.append(collector)
+
+def stats_samples(prefix: str, stats: Dict, labels: Optional[Dict[str, str]] = None):
+    """Turn the numeric entries of a component's stats() dict into gauge samples."""
+    for key, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}_{key}", labels or {}, value
+
+def render() -> str:
+    """Render every metric in the Prometheus text format."""
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+
+    gauges: Dict[str, List[str]] = {}
+    for collector in _collectors:
+        try:
+            for name, labels, value in collector():
+                label_text = _format_labels(tuple(labels), tuple(labels.values()))
+                gauges.setdefault(name, []).append(f"{name}{label_text} {value}")
+        except Exception as e:
+            print(f"Error collecting metrics: {e}")
+    for name, samples in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+class TimingMiddleware:
+    """ASGI middleware: request latency histogram and Server-Timing header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: Dict[str, float] = {}
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if timings:
+                    value = ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items())
+                    message["headers"] = list(message.get("headers", [])) + [(b"server-timing", value.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timings.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"], path, str(status_code))
@@ -0,0 +1,316 @@
+"""Versioned schema migrations for the chatbot database.
+
+initialize_database() creates the base tables and then calls apply_migrations(),
+which runs every migration newer than the version recorded in the
+schema_migrations table, in order, each in its own transaction. Migrations are
+append-only: never edit or reorder one that has shipped, add a new one instead.
+
+Each migration belongs to a scope: DIRECTORY (users, caches and everything
+else shared by all shards, in DATABASE_FILE) or SHARD (conversations and
+their messages, in every shard file; see shards.py). A file is migrated in
+the scopes it holds, and versions are recorded per scope, so shard files
+never get empty copies of the directory tables. With DB_SHARDS=1 the one
+file holds both.
+
+Run `python migrations.py [--check]` to show the schema version and the query
+plans of the hot queries; --check exits non-zero if one of them scans a table.
+tests/test_migrations.py runs the same check in CI.
+"""
+import sqlite3
+import sys
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+DIRECTORY = "directory"
+SHARD = "shard"
+SCOPES = (DIRECTORY, SHARD)
+
+# (version, scope, description, statements or callable taking a cursor)
+Migration = Tuple[int, str, str, Union[List[str], Callable[[sqlite3.Cursor], None]]]
+
+def _create_conversation_directory(cursor: sqlite3.Cursor):
+    """Allocate conversation IDs (and record their owners) in one place for all shards."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS conversation_directory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL
+        )
+        """
+    )
+    # Number of shards the conversations are currently split into
+    cursor.execute("CREATE TABLE IF NOT EXISTS shard_layout (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    # Conversations stored here from before sharding
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversations'")
+    if cursor.fetchone() is None:
+        return
+    cursor.execute("INSERT INTO conversation_directory (id, user_id) SELECT id, user_id FROM conversations")
+    # Never hand out the ID of a deleted conversation again: its orphaned
+    # messages would show up in the new one.
+    row = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'conversations'").fetchone()
+    if row:
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'conversation_directory'")
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('conversation_directory', ?)", (row[0],))
+
+MIGRATIONS: List[Migration] = [
+    (1, SHARD, "index messages by conversation", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id)",
+    ]),
+    (2, SHARD, "index conversations by user and recency", [
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations (user_id, updated_at DESC, id DESC)",
+    ]),
+    (3, SHARD, "rolling conversation summaries", [
+        """
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            conversation_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            summarized_through INTEGER NOT NULL,
+            summarized_tokens INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+        )
+        """,
+    ]),
+    (4, DIRECTORY, "persistent LLM response cache", [
+        """
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)",
+    ]),
+    # The index is kept in sync by database.py wherever it writes messages,
+    # not by triggers: from migration 6 on, message text has to be read
+    # through msg_text(), and triggers calling it made every write to messages
+    # fail on connections without the function (sqlite3 shell, repair
+    # scripts). Each row carries an owner token ('u' || user_id) that searches
+    # AND with the query, so only the user's rows are matched.
+    (5, SHARD, "full-text search over messages", [
+        """
+        CREATE VIEW IF NOT EXISTS messages_text AS
+        SELECT m.id, m.content, 'u' || c.user_id AS owner
+        FROM messages m JOIN conversations c ON c.id = m.conversation_id
+        """,
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content,
+            owner,
+            content='messages_text',
+            content_rowid='id',
+            tokenize='porter unicode61'
+        )
+        """,
+        # Backfill the index from existing messages
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ]),
+    # messages.content may now be compressed (see compression.py), so the
+    # full-text index reads message text through msg_text() for snippets and
+    # rebuilds. Existing rows are plain text, so the index stays valid.
+    (6, SHARD, "compressed message content", [
+        "ALTER TABLE messages ADD COLUMN codec INTEGER NOT NULL DEFAULT 0",
+        "DROP VIEW IF EXISTS messages_text",
+        """
+        CREATE VIEW messages_text AS
+        SELECT m.id, msg_text(m.codec, m.content) AS content, 'u' || c.user_id AS owner
+        FROM messages m JOIN conversations c ON c.id = m.conversation_id
+        """,
+    ]),
+    (6, DIRECTORY, "message compression dictionaries", [
+        """
+        CREATE TABLE IF NOT EXISTS compression_dicts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            algorithm TEXT NOT NULL,
+            dictionary BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (7, SHARD, "archive idle conversations", [
+        "ALTER TABLE conversations ADD COLUMN archived_at TIMESTAMP",
+        "ALTER TABLE conversations ADD COLUMN rehydrated_at TIMESTAMP",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_idle ON conversations (updated_at) WHERE archived_at IS NULL",
+    ]),
+    (8, DIRECTORY, "conversation directory for sharding", _create_conversation_directory),
+    (9, DIRECTORY, "daily LLM token usage per user", [
+        """
+        CREATE TABLE IF NOT EXISTS llm_usage (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            tokens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+        """,
+    ]),
+]
+
+# Queries on the request path that must be served by an index, by name: (scope, query, params).
+HOT_QUERIES: Dict[str, Tuple[str, str, tuple]] = {
+    "get_conversation_messages": (
+        SHARD,
+        "SELECT id, role, content, codec, timestamp FROM messages WHERE conversation_id = ? AND id > ? ORDER BY id ASC",
+        (1, 0),
+    ),
+    "get_conversation_messages (page)": (
+        SHARD,
+        "SELECT id, role, content, codec, timestamp FROM messages WHERE conversation_id = ? AND id > ? AND id < ? ORDER BY id DESC LIMIT ?",
+        (1, 0, 100, 50),
+    ),
+    "get_user_conversations": (
+        SHARD,
+        "SELECT id, title, created_at, updated_at, archived_at FROM conversations WHERE user_id = ? ORDER BY updated_at DESC, id DESC LIMIT ?",
+        (1, -1),
+    ),
+    "get_user_conversations (page)": (
+        SHARD,
+        "SELECT id, title, created_at, updated_at, archived_at FROM conversations WHERE user_id = ? "
+        "AND (updated_at, id) < (?, ?) "
+        "ORDER BY updated_at DESC, id DESC LIMIT ?",
+        (1, "2024-01-01 00:00:00", 10, 50),
+    ),
+    "get_conversation_by_id": (
+        SHARD,
+        "SELECT id, title, created_at, updated_at, archived_at FROM conversations WHERE id = ? AND user_id = ?",
+        (1, 1),
+    ),
+    "get_conversation_version": (
+        SHARD,
+        "SELECT c.id, c.title, c.updated_at, c.archived_at, "
+        "(SELECT MAX(id) FROM messages WHERE conversation_id = c.id) AS last_message_id "
+        "FROM conversations c WHERE c.id = ? AND c.user_id = ?",
+        (1, 1),
+    ),
+    "export_user_history": (
+        SHARD,
+        "SELECT c.id, m.id, m.content FROM conversations c LEFT JOIN messages m ON m.conversation_id = c.id "
+        "WHERE c.user_id = ? ORDER BY c.updated_at DESC, c.id DESC, m.id",
+        (1,),
+    ),
+    "archive_idle_conversations": (
+        SHARD,
+        "SELECT id, user_id FROM conversations WHERE archived_at IS NULL "
+        "AND updated_at < datetime('now', ?) AND (rehydrated_at IS NULL OR rehydrated_at < datetime('now', ?)) "
+        "ORDER BY updated_at LIMIT ?",
+        ("-365 days", "-365 days", 100),
+    ),
+    "conversation_shard": (
+        DIRECTORY,
+        "SELECT user_id FROM conversation_directory WHERE id = ?",
+        (1,),
+    ),
+    "get_llm_usage": (
+        DIRECTORY,
+        "SELECT tokens FROM llm_usage WHERE user_id = ? AND day = ?",
+        (1, "2024-01-01"),
+    ),
+    "get_user_by_username": (
+        DIRECTORY,
+        "SELECT * FROM users WHERE username = ?",
+        ("user",),
+    ),
+}
+
+def _ensure_migrations_table(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER NOT NULL,
+            scope TEXT NOT NULL,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (version, scope)
+        )
+        """
+    )
+
+def get_schema_version(conn: sqlite3.Connection, scope: Optional[str] = None) -> int:
+    """Return the highest applied migration version of a scope, or of any scope (0 if none)."""
+    _ensure_migrations_table(conn)
+    if scope is None:
+        row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+    else:
+        row = conn.execute("SELECT MAX(version) FROM schema_migrations WHERE scope = ?", (scope,)).fetchone()
+    return row[0] or 0
+
+def get_schema_scopes(conn: sqlite3.Connection) -> List[str]:
+    """The scopes a database file has been migrated in."""
+    _ensure_migrations_table(conn)
+    return [row[0] for row in conn.execute("SELECT DISTINCT scope FROM schema_migrations ORDER BY scope")]
+
+def apply_migrations(conn: sqlite3.Connection, scopes: Sequence[str] = SCOPES) -> int:
+    """Apply pending migrations of the given scopes and return the resulting schema version."""
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None  # manage transactions explicitly so DDL is covered
+    try:
+        versions = {scope: get_schema_version(conn, scope) for scope in scopes}
+        for migration_version, scope, description, body in MIGRATIONS:
+            if scope not in versions or migration_version <= versions[scope]:
+                continue
+
+            cursor = conn.cursor()
+            # BEGIN IMMEDIATE takes the write lock, so concurrent workers
+            # starting up at once apply each migration exactly once.
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                if get_schema_version(conn, scope) >= migration_version:
+                    cursor.execute("COMMIT")
+                    continue
+                if callable(body):
+                    body(cursor)
+                else:
+                    for statement in body:
+                        cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, scope, description) VALUES (?, ?, ?)",
+                    (migration_version, scope, description)
+                )
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            print(f"Applied migration {migration_version} ({scope}): {description}")
+            versions[scope] = migration_version
+        return max(versions.values(), default=0)
+    finally:
+        conn.isolation_level = isolation_level
+
+def explain_hot_queries(conn: sqlite3.Connection, scopes: Sequence[str] = SCOPES) -> Dict[str, List[str]]:
+    """Return the EXPLAIN QUERY PLAN details for each hot query of the given scopes."""
+    plans = {}
+    for name, (scope, query, params) in HOT_QUERIES.items():
+        if scope not in scopes:
+            continue
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+        plans[name] = [row[3] for row in rows]
+    return plans
+
+def find_unindexed_queries(conn: sqlite3.Connection, scopes: Sequence[str] = SCOPES) -> Dict[str, List[str]]:
+    """Return the hot queries whose plan contains a full scan or a temp B-tree sort."""
+    return {
+        name: plan
+        for name, plan in explain_hot_queries(conn, scopes).items()
+        if any(step.startswith("SCAN") or "TEMP B-TREE" in step for step in plan)
+    }
+
+if __name__ == "__main__":
+    import compression
+    import database
+
+    database.initialize_database()
+    unindexed = {}
+    for path in dict.fromkeys([database.DATABASE_FILE, *database.shard_files()]):
+        connection = sqlite3.connect(path)
+        compression.install(connection)
+        file_scopes = get_schema_scopes(connection)
+        print(f"{path} ({', '.join(file_scopes)}): schema version {get_schema_version(connection)}")
+        for query_name, query_plan in explain_hot_queries(connection, file_scopes).items():
+            print(f"{query_name}:")
+            for step in query_plan:
+                print(f"    {step}")
+        unindexed.update(find_unindexed_queries(connection, file_scopes))
+        connection.close()
+
+    if unindexed and "--check" in sys.argv:
+        print(f"Queries without index support: {', '.join(unindexed)}")
+        sys.exit(1)
@@ -0,0 +1,202 @@
+"""Per-user request rate limits and daily LLM token quotas.
+
+Chat requests (/chat, /chat/stream and WebSocket turns) draw from a token
+bucket per user: CHAT_RATE_PER_MINUTE sustained, CHAT_BURST at once. Login
+and registration draw from a bucket per client IP. Separately, the LLM
+tokens (prompt + completion) each user's upstream calls consume are counted
+per UTC day; once LLM_DAILY_TOKEN_QUOTA is used up, chat requests are
+refused until midnight UTC. Throttled callers get 429 with Retry-After.
+
+Checks are in-memory dictionary lookups. Usage counters are written to
+SQLite in batches every USAGE_FLUSH_SECONDS, and each flush reads back the
+totals so workers see each other's usage. The quota is soft: a request
+admitted just under it can overshoot by one completion, and a worker may
+lag the others by up to one flush interval.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Tuple
+
+from fastapi import Depends, HTTPException, Request, status
+
+import async_db
+from auth import get_current_user
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+CHAT_RATE_PER_MINUTE = float(os.getenv("CHAT_RATE_PER_MINUTE", "20"))
+CHAT_BURST = float(os.getenv("CHAT_BURST", "20"))
+AUTH_RATE_PER_MINUTE = float(os.getenv("AUTH_RATE_PER_MINUTE", "10"))
+AUTH_BURST = float(os.getenv("AUTH_BURST", "5"))
+# LLM tokens per user per UTC day (0 disables the quota)
+LLM_DAILY_TOKEN_QUOTA = int(os.getenv("LLM_DAILY_TOKEN_QUOTA", "200000"))
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "5"))
+# Buckets kept in memory; the least recently used key is dropped (refilled) first
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+if CHAT_RATE_PER_MINUTE <= 0 or AUTH_RATE_PER_MINUTE <= 0 or CHAT_BURST < 1 or AUTH_BURST < 1:
+    raise ValueError("Rate limits need a positive rate and a burst of at least 1")
+
+class TokenBucketLimiter:
+    """Token buckets by key, refilled continuously at `rate_per_minute`."""
+
+    def __init__(self, rate_per_minute: float, burst: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (tokens, last refill)
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._stats = {"allowed": 0, "throttled": 0}
+
+    def acquire(self, key: str, cost: float = 1.0) -> float:
+        """Take `cost` tokens from a key's bucket.
+
+        Returns 0 when allowed, otherwise the seconds until the bucket holds
+        enough tokens (nothing is taken then).
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= cost:
+            tokens -= cost
+            retry_after = 0.0
+            self._stats["allowed"] += 1
+        else:
+            retry_after = (cost - tokens) / self.rate
+            self._stats["throttled"] += 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+    def stats(self) -> Dict:
+        return {"keys": len(self._buckets), **self._stats}
+
+def utc_day() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+def seconds_until_utc_midnight() -> float:
+    now = datetime.now(timezone.utc)
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (midnight - now).total_seconds()
+
+class UsageQuota:
+    """Daily LLM token counts per user, cached in memory and flushed to SQLite in batches."""
+
+    def __init__(self, daily_tokens: int = LLM_DAILY_TOKEN_QUOTA):
+        self.daily_tokens = daily_tokens
+        self._day = utc_day()
+        # Today's totals for users seen today (including unflushed usage)
+        self._used: Dict[int, int] = {}
+        # Usage not yet written, by (day, user_id)
+        self._pending: Dict[Tuple[str, int], int] = {}
+        self._stats = {"exceeded": 0, "flushes": 0, "flush_failures": 0}
+
+    def _roll(self) -> str:
+        day = utc_day()
+        if day != self._day:
+            self._day = day
+            self._used.clear()
+        return day
+
+    async def used(self, user_id: int) -> int:
+        """Tokens the user has used today; read from the database once per day."""
+        day = self._roll()
+        if user_id not in self._used:
+            stored = await async_db.get_llm_usage(user_id, day)
+            if self._day == day and user_id not in self._used:
+                self._used[user_id] = stored + self._pending.get((day, user_id), 0)
+        return self._used.get(user_id, 0)
+
+    async def exhausted(self, user_id: int) -> bool:
+        if self.daily_tokens <= 0:
+            return False
+        if await self.used(user_id) < self.daily_tokens:
+            return False
+        self._stats["exceeded"] += 1
+        return True
+
+    def record(self, user_id: int, tokens: int):
+        """Count tokens consumed by one of the user's upstream calls."""
+        if tokens <= 0:
+            return
+        day = self._roll()
+        key = (day, user_id)
+        self._pending[key] = self._pending.get(key, 0) + tokens
+        if user_id in self._used:
+            self._used[user_id] += tokens
+
+    async def flush(self):
+        """Write pending usage in one transaction and pick up other workers' totals."""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        totals = await async_db.add_llm_usage(batch)
+        if totals is None:
+            self._stats["flush_failures"] += 1
+            for key, tokens in batch.items():
+                self._pending[key] = self._pending.get(key, 0) + tokens
+            return
+        self._stats["flushes"] += 1
+        for (day, user_id), total in totals.items():
+            if day == self._day and user_id in self._used:
+                self._used[user_id] = total + self._pending.get((day, user_id), 0)
+
+    async def run(self):
+        """Flush every USAGE_FLUSH_SECONDS until cancelled."""
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_SECONDS)
+            await self.flush()
+
+    def stats(self) -> Dict:
+        return {
+            "daily_tokens": self.daily_tokens,
+            "users_today": len(self._used),
+            "pending_users": len(self._pending),
+            **self._stats,
+        }
+
+chat_limiter = TokenBucketLimiter(CHAT_RATE_PER_MINUTE, CHAT_BURST)
+auth_limiter = TokenBucketLimiter(AUTH_RATE_PER_MINUTE, AUTH_BURST)
+llm_usage = UsageQuota()
+
+def too_many_requests(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=detail,
+        headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+    )
+
+async def check_chat_limits(user_id: int):
+    """Raise 429 if the user is over their chat request rate or daily LLM token quota."""
+    if not RATE_LIMIT_ENABLED:
+        return
+    if await llm_usage.exhausted(user_id):
+        raise too_many_requests("Daily LLM token quota exceeded", seconds_until_utc_midnight())
+    retry_after = chat_limiter.acquire(str(user_id))
+    if retry_after:
+        raise too_many_requests("Too many chat requests, please slow down", retry_after)
+
+async def chat_user(current_user_id: int = Depends(get_current_user)) -> int:
+    """get_current_user for LLM endpoints, enforcing the chat limits."""
+    await check_chat_limits(current_user_id)
+    return current_user_id
+
+async def limit_auth_attempts(request: Request):
+    """Per-IP limit for login and registration."""
+    if not RATE_LIMIT_ENABLED:
+        return
+    client_ip = request.client.host if request.client else "unknown"
+    retry_after = auth_limiter.acquire(client_ip)
+    if retry_after:
+        raise too_many_requests("Too many attempts, please try again later", retry_after)
+
+def stats() -> Dict:
+    return {
+        "enabled": RATE_LIMIT_ENABLED,
+        "chat": chat_limiter.stats(),
+        "auth": auth_limiter.stats(),
+        "llm_usage": llm_usage.stats(),
+    }
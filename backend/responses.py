@@ -0,0 +1,188 @@
+"""Conditional GET and compression of HTTP responses.
+
+Conversation endpoints send a weak ETag (and Last-Modified) computed from a
+cheap validator, and answer a matching If-None-Match with 304 before loading
+the full response. Responses carry `Cache-Control: private, no-cache`, so
+browsers revalidate on every fetch instead of re-downloading.
+
+CompressionMiddleware compresses complete JSON/text responses of at least
+RESPONSE_COMPRESSION_MIN_BYTES with Brotli (if the optional `brotli` package
+is installed and the client accepts it) or gzip. Streamed responses (SSE,
+NDJSON export) pass through untouched so their chunks are not held back.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+import anyio
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+# Smaller responses are sent as they are (0 disables compression)
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
+RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", "4"))
+# Bodies at least this large are compressed on a worker thread, not the event loop
+RESPONSE_COMPRESSION_THREAD_BYTES = int(os.getenv("RESPONSE_COMPRESSION_THREAD_BYTES", str(256 * 1024)))
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript")
+
+CACHE_CONTROL = "private, no-cache"
+
+_stats_lock = threading.Lock()
+_stats = {"not_modified": 0, "compressed": 0, "bytes_in": 0, "bytes_out": 0}
+
+def _count(**increments: int):
+    with _stats_lock:
+        for key, value in increments.items():
+            _stats[key] += value
+
+def stats() -> Dict:
+    with _stats_lock:
+        return {"brotli": brotli is not None, **_stats}
+
+def make_etag(*parts: Any) -> str:
+    """Weak ETag over the values a representation depends on."""
+    digest = hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+def http_date(timestamp: Optional[str]) -> Optional[str]:
+    """HTTP date for a SQLite CURRENT_TIMESTAMP value (UTC)."""
+    if not timestamp:
+        return None
+    try:
+        moment = datetime.strptime(timestamp[:19], "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+    return format_datetime(moment.replace(tzinfo=timezone.utc), usegmt=True)
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[str] = None) -> bool:
+    """Whether the client's cached copy is current.
+
+    If-None-Match wins over If-Modified-Since, whose one-second resolution
+    can miss changes within the same second.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        opaque = etag[2:] if etag.startswith("W/") else etag
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        return any((tag[2:] if tag.startswith("W/") else tag) == opaque for tag in candidates)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def _validator_headers(etag: str, last_modified: Optional[str]) -> Dict[str, str]:
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+    return headers
+
+def not_modified(etag: str, last_modified: Optional[str] = None) -> Response:
+    _count(not_modified=1)
+    return Response(status_code=304, headers=_validator_headers(etag, last_modified))
+
+def cacheable_json(content: Any, etag: str, last_modified: Optional[str] = None) -> JSONResponse:
+    return JSONResponse(content, headers=_validator_headers(etag, last_modified))
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Preferred content coding the client accepts: br, then gzip."""
+    accepted: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    wildcard = accepted.get("*", 0.0)
+    if brotli is not None and accepted.get("br", wildcard) > 0:
+        return "br"
+    if accepted.get("gzip", wildcard) > 0:
+        return "gzip"
+    return None
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+
+class CompressionMiddleware:
+    """ASGI middleware: gzip/Brotli for complete responses above a size threshold."""
+
+    def __init__(self, app, minimum_size: int = RESPONSE_COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.minimum_size <= 0:
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        pending_start = None
+
+        async def send_compressed(message):
+            nonlocal pending_start
+            if message["type"] == "http.response.start":
+                # Hold the headers until the body shows whether to compress
+                pending_start = message
+                return
+            if message["type"] != "http.response.body" or pending_start is None:
+                await send(message)
+                return
+
+            start, pending_start = pending_start, None
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=list(start.get("headers", [])))
+            content_type = headers.get("content-type", "")
+            if (
+                message.get("more_body", False)
+                or len(body) < self.minimum_size
+                or "content-encoding" in headers
+                or not content_type.startswith(COMPRESSIBLE_TYPES)
+            ):
+                await send(start)
+                await send(message)
+                return
+
+            with metrics.stage_timer("compress"):
+                if len(body) >= RESPONSE_COMPRESSION_THREAD_BYTES:
+                    compressed = await anyio.to_thread.run_sync(compress, body, encoding)
+                else:
+                    compressed = compress(body, encoding)
+            headers.add_vary_header("Accept-Encoding")
+            if len(compressed) >= len(body):
+                await send({**start, "headers": headers.raw})
+                await send(message)
+                return
+            _count(compressed=1, bytes_in=len(body), bytes_out=len(compressed))
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            await send({**start, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
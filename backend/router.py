@@ -0,0 +1,268 @@
+"""Routing, hedging and fallback for upstream LLM calls.
+
+Backends are configured with LLM_BACKENDS, a JSON list tried in order:
+
+    [{"name": "8b", "model": "llama-3.1-8b-instant", "max_prompt_tokens": 3000},
+     {"name": "70b", "model": "llama-3.3-70b-versatile"}]
+
+Optional keys are base_url, api_key_env (default GROQ_API_KEY),
+max_prompt_tokens, max_tokens and timeout. A prompt is routed to the backends
+whose max_prompt_tokens it fits, in order. If the first one has not produced a
+token within its observed p95 time-to-first-token, a hedged duplicate goes to
+the next candidate (or the same backend if there is only one); whichever
+produces a token first wins and the other is cancelled. Hedges are capped at
+LLM_HEDGE_MAX_RATIO of all calls. A backend that fails before its first token
+falls back to the next candidate. Once tokens have been streamed there is no
+fallback.
+"""
+import asyncio
+import inspect
+import json
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from groq import AsyncGroq
+
+import context
+from scheduler import with_retries
+
+DEFAULT_BACKENDS = [{"name": "groq", "model": "llama-3.1-8b-instant"}]
+LLM_BACKENDS = json.loads(os.getenv("LLM_BACKENDS", "") or json.dumps(DEFAULT_BACKENDS))
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.getenv("LLM_REQUEST_TIMEOUT_SECONDS", "60"))
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "1") == "1"
+LLM_HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.1"))
+# Until a backend has LLM_HEDGE_MIN_SAMPLES TTFT samples, hedge after the default delay
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "2.0"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.05"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW", "500"))
+
+async def _close(completion: Any):
+    """Close an upstream stream so the backend stops generating."""
+    close = getattr(completion, "aclose", None) or getattr(completion, "close", None)
+    if close is not None:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+
+def _has_content(chunk: Any) -> bool:
+    return bool(chunk.choices) and bool(chunk.choices[0].delta.content)
+
+class Backend:
+    """One model endpoint plus its recent time-to-first-token samples."""
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        base_url: Optional[str] = None,
+        api_key_env: str = "GROQ_API_KEY",
+        max_prompt_tokens: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        timeout: float = LLM_REQUEST_TIMEOUT_SECONDS
+    ):
+        self.name = name
+        self.model = model
+        self.base_url = base_url
+        self.api_key_env = api_key_env
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self._client = None
+        self._ttft: Deque[float] = deque(maxlen=LLM_HEDGE_WINDOW)
+        self._stats = {"requests": 0, "wins": 0, "errors": 0, "cancelled": 0}
+
+    @property
+    def client(self):
+        # Created on first use so the API key can come from .env
+        if self._client is None:
+            self._client = AsyncGroq(
+                api_key=os.getenv(self.api_key_env),
+                base_url=self.base_url,
+                timeout=self.timeout,
+                max_retries=0,
+            )
+        return self._client
+
+    @client.setter
+    def client(self, value):
+        self._client = value
+
+    def fits(self, prompt_tokens: int) -> bool:
+        return self.max_prompt_tokens is None or prompt_tokens <= self.max_prompt_tokens
+
+    def observe_ttft(self, seconds: float):
+        self._ttft.append(seconds)
+
+    def ttft_quantile(self, q: float) -> Optional[float]:
+        """Quantile of recent time-to-first-token, or None with too few samples."""
+        if len(self._ttft) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self._ttft)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    async def open(self, messages: List[Dict[str, str]], max_tokens: int):
+        """Start a streaming completion (transient errors are retried)."""
+        if self.max_tokens:
+            max_tokens = min(max_tokens, self.max_tokens)
+        return await with_retries(lambda: self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=1,
+            max_tokens=max_tokens,
+            top_p=1,
+            stream=True,
+            stop=None,
+        ))
+
+    async def first_chunks(self, messages: List[Dict[str, str]], max_tokens: int):
+        """Open a stream and read it up to the first content chunk.
+
+        Returns (completion, iterator, chunks read so far). The stream is closed
+        if this fails or is cancelled.
+        """
+        start = time.perf_counter()
+        completion = await self.open(messages, max_tokens)
+        iterator = completion.__aiter__()
+        chunks = []
+        try:
+            async for chunk in iterator:
+                chunks.append(chunk)
+                if _has_content(chunk):
+                    self.observe_ttft(time.perf_counter() - start)
+                    break
+        except BaseException:
+            await _close(completion)
+            raise
+        return completion, iterator, chunks
+
+    def stats(self) -> Dict:
+        return {
+            "model": self.model,
+            "ttft_p50_seconds": self.ttft_quantile(0.5),
+            "ttft_p95_seconds": self.ttft_quantile(0.95),
+            **self._stats,
+        }
+
+class Router:
+    """Picks, hedges and falls back between LLM backends."""
+
+    def __init__(self, backends: List[Backend], hedge_enabled: bool = LLM_HEDGE_ENABLED, hedge_max_ratio: float = LLM_HEDGE_MAX_RATIO):
+        if not backends:
+            raise ValueError("At least one LLM backend is required")
+        self.backends = backends
+        self.hedge_enabled = hedge_enabled
+        self.hedge_max_ratio = hedge_max_ratio
+        self._stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "fallbacks": 0}
+
+    def candidates(self, prompt_tokens: int) -> List[Backend]:
+        """Backends that can take a prompt of this size, in preference order."""
+        fitting = [backend for backend in self.backends if backend.fits(prompt_tokens)]
+        if fitting:
+            return fitting
+        return [max(self.backends, key=lambda backend: backend.max_prompt_tokens or 0)]
+
+    def route_key(self, messages: List[Dict[str, str]], max_tokens: int) -> str:
+        """The backends and models that could answer these messages, for cache and singleflight keys."""
+        prompt_tokens = sum(context.message_tokens(msg) for msg in messages)
+        models = ",".join(
+            f"{backend.name}={backend.model}@{backend.base_url or ''}/{backend.max_tokens or ''}"
+            for backend in self.candidates(prompt_tokens)
+        )
+        return f"{models}:{max_tokens}"
+
+    def hedge_delay(self, backend: Backend) -> Optional[float]:
+        """Seconds to wait for a first token before hedging, or None to not hedge."""
+        if not self.hedge_enabled or self._stats["hedged"] >= self.hedge_max_ratio * self._stats["requests"]:
+            return None
+        p95 = backend.ttft_quantile(0.95)
+        return max(LLM_HEDGE_MIN_DELAY, p95 if p95 is not None else LLM_HEDGE_DEFAULT_DELAY)
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 1024,
+        route: Optional[Dict] = None
+    ) -> AsyncIterator[Any]:
+        """Stream completion chunks from the winning backend.
+
+        `route` is filled in with the winning backend, its model, whether the
+        call was hedged and how many upstream attempts were made.
+        """
+        route = route if route is not None else {}
+        self._stats["requests"] += 1
+        prompt_tokens = sum(context.message_tokens(msg) for msg in messages)
+        remaining = self.candidates(prompt_tokens)
+        # attempt task -> (backend, whether it is the hedge)
+        attempts: Dict[asyncio.Task, Tuple[Backend, bool]] = {}
+        launched = 0
+
+        def launch(backend: Backend, hedge: bool = False):
+            nonlocal launched
+            launched += 1
+            backend._stats["requests"] += 1
+            attempts[asyncio.create_task(backend.first_chunks(messages, max_tokens))] = (backend, hedge)
+
+        primary = remaining.pop(0)
+        launch(primary)
+        delay = self.hedge_delay(primary)
+        hedge_at = time.monotonic() + delay if delay is not None else None
+        hedged = False
+        error: Optional[BaseException] = None
+        winner = None
+        try:
+            while winner is None:
+                if not attempts:
+                    if not remaining:
+                        raise error
+                    self._stats["fallbacks"] += 1
+                    launch(remaining.pop(0))
+                timeout = None
+                if hedge_at is not None and not hedged:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self._stats["hedged"] += 1
+                    launch(remaining.pop(0) if remaining else primary, hedge=True)
+                    continue
+                for task in done:
+                    backend, hedge = attempts.pop(task)
+                    if task.exception() is not None:
+                        backend._stats["errors"] += 1
+                        error = task.exception()
+                    elif winner is None:
+                        winner = backend, hedge, task.result()
+                    else:
+                        # Two attempts got a token at once; keep the first
+                        await _close(task.result()[0])
+        finally:
+            for task, (backend, _) in attempts.items():
+                task.cancel()
+                backend._stats["cancelled"] += 1
+            if attempts:
+                await asyncio.gather(*attempts, return_exceptions=True)
+
+        backend, hedge, (completion, iterator, chunks) = winner
+        backend._stats["wins"] += 1
+        if hedge:
+            self._stats["hedge_wins"] += 1
+        route.update({"backend": backend.name, "model": backend.model, "hedged": hedged, "attempts": launched})
+        try:
+            for chunk in chunks:
+                yield chunk
+            async for chunk in iterator:
+                yield chunk
+        finally:
+            await _close(completion)
+
+    def stats(self) -> Dict:
+        return dict(self._stats)
+
+def load_backends(config: List[Dict] = LLM_BACKENDS) -> List[Backend]:
+    """Build backends from LLM_BACKENDS-style config."""
+    return [Backend(**entry) for entry in config]
+
+llm_router = Router(load_backends())
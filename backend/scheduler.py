@@ -0,0 +1,193 @@
+"""Admission control for upstream LLM calls.
+
+At most LLM_MAX_IN_FLIGHT calls run at once. Further calls wait in per-user
+FIFO queues that are served round-robin, so one heavy user cannot starve the
+rest. Waiting is bounded: a call is shed with Overloaded (a fast 503 with
+Retry-After) when the queue or the user's share of it is full, when its
+estimated wait already exceeds LLM_QUEUE_TIMEOUT_SECONDS, or when that deadline
+passes while it waits.
+
+with_retries() retries transient upstream failures (429, 5xx, connection
+errors) with exponential backoff and full jitter, honouring the upstream
+Retry-After header when there is one.
+"""
+import asyncio
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+import groq
+
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "16"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+LLM_MAX_QUEUE_PER_USER = int(os.getenv("LLM_MAX_QUEUE_PER_USER", "4"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+
+T = TypeVar("T")
+
+class Overloaded(Exception):
+    """Raised when a call is shed instead of queued; retry_after is in seconds."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+class AdmissionScheduler:
+    """Concurrency limiter with a bounded, per-user fair wait queue."""
+
+    def __init__(
+        self,
+        max_in_flight: int = LLM_MAX_IN_FLIGHT,
+        max_queue: int = LLM_MAX_QUEUE,
+        max_queue_per_user: int = LLM_MAX_QUEUE_PER_USER,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT_SECONDS
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._waiting = 0
+        # Moving average of how long an admitted call holds its slot
+        self._service_time = 2.0
+        self._stats = {"admitted": 0, "queued": 0, "shed": 0, "expired": 0}
+
+    def estimated_wait(self, position: int) -> float:
+        """Expected queueing delay for a waiter at `position` in line."""
+        return (position // self.max_in_flight + 1) * self._service_time
+
+    def _position(self, user_key: str) -> int:
+        """Waiters served before a new waiter from `user_key` under round-robin."""
+        own = len(self._queues.get(user_key, ()))
+        return sum(min(len(queue), own + 1) for queue in self._queues.values())
+
+    def _shed(self, reason: str, retry_after: float):
+        self._stats["shed"] += 1
+        raise Overloaded(f"LLM capacity exhausted ({reason})", retry_after)
+
+    async def acquire(self, user_key: str):
+        """Wait for a slot or raise Overloaded."""
+        if self.in_flight < self.max_in_flight and self._waiting == 0:
+            self.in_flight += 1
+            self._stats["admitted"] += 1
+            return
+
+        queue = self._queues.get(user_key)
+        expected_wait = self.estimated_wait(self._position(user_key))
+        if self._waiting >= self.max_queue:
+            self._shed("queue full", expected_wait)
+        if queue is not None and len(queue) >= self.max_queue_per_user:
+            self._shed("too many pending requests for this user", expected_wait)
+        if expected_wait > self.queue_timeout:
+            self._shed("estimated wait exceeds deadline", expected_wait)
+
+        future = asyncio.get_running_loop().create_future()
+        if queue is None:
+            queue = self._queues[user_key] = deque()
+        queue.append(future)
+        self._waiting += 1
+        self._stats["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if self._remove_waiter(user_key, future):
+                self._stats["expired"] += 1
+                self._shed("queue deadline passed", self._service_time)
+            # Admitted just as the deadline hit: keep the slot
+        except BaseException:
+            if not self._remove_waiter(user_key, future):
+                self.release()  # admitted, but the caller went away
+            raise
+
+    def _remove_waiter(self, user_key: str, future: asyncio.Future) -> bool:
+        queue = self._queues.get(user_key)
+        if queue is None or future not in queue:
+            return False
+        queue.remove(future)
+        self._waiting -= 1
+        if not queue:
+            del self._queues[user_key]
+        return True
+
+    def release(self, service_time: Optional[float] = None):
+        """Free a slot and hand it to the next user in round-robin order."""
+        if service_time is not None:
+            self._service_time = 0.9 * self._service_time + 0.1 * service_time
+        self.in_flight -= 1
+        while self._queues and self.in_flight < self.max_in_flight:
+            user_key, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            self._waiting -= 1
+            if queue:
+                self._queues.move_to_end(user_key)  # next user gets the following slot
+            else:
+                del self._queues[user_key]
+            if not future.done():
+                self.in_flight += 1
+                self._stats["admitted"] += 1
+                future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user_key: str):
+        await self.acquire(user_key)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "waiting": self._waiting,
+            "waiting_users": len(self._queues),
+            "service_time_seconds": self._service_time,
+            **self._stats,
+        }
+
+def retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying `error`, or None if it is not retryable."""
+    if isinstance(error, groq.APIStatusError):
+        if error.status_code != 429 and error.status_code < 500:
+            return None
+        headers = error.response.headers
+        for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+            value = headers.get(header)
+            if value:
+                try:
+                    return min(float(value) * scale, LLM_RETRY_MAX_DELAY)
+                except ValueError:
+                    pass
+    elif not isinstance(error, (groq.APIConnectionError, groq.APITimeoutError)):
+        return None
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+retry_stats = {"retries": 0, "gave_up": 0}
+
+async def with_retries(call: Callable[[], Awaitable[T]], max_retries: int = LLM_MAX_RETRIES) -> T:
+    """Await call(), retrying transient upstream failures."""
+    attempt = 0
+    while True:
+        try:
+            return await call()
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None:
+                raise
+            if attempt >= max_retries:
+                retry_stats["gave_up"] += 1
+                raise
+            attempt += 1
+            retry_stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+llm_scheduler = AdmissionScheduler()
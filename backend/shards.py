@@ -0,0 +1,69 @@
+"""Sharding of conversation storage by user.
+
+Users, the LLM response cache and compression dictionaries live in the
+directory database (DATABASE_FILE). Conversations, their messages, summaries
+and full-text index are spread over DB_SHARDS SQLite files, so writes from
+different users stop queueing on one file's write lock. A user's shard is
+crc32(user_id) % DB_SHARDS, which is the same in every worker process. With
+DB_SHARDS=1 (the default) the directory file is also the only shard;
+otherwise each file only has the tables of its role (see migrations.py).
+
+Conversation IDs are allocated in the directory (conversation_directory),
+which also maps each conversation to its owner so functions that only get a
+conversation ID can find its shard. Each shard file allocates message IDs
+from its own range of 2**SHARD_ID_BITS, so rows keep their IDs when moved
+between shards.
+
+Changing DB_SHARDS needs the data moved first, with the server stopped:
+
+    python shards.py reshard 4
+    DB_SHARDS=4 uvicorn app:app --workers 4
+"""
+import os
+import zlib
+
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+# Message IDs allocated by one shard file start at a multiple of 2**SHARD_ID_BITS
+SHARD_ID_BITS = 40
+# Conversation -> owner entries kept in memory (owners never change)
+SHARD_DIRECTORY_CACHE_SIZE = int(os.getenv("SHARD_DIRECTORY_CACHE_SIZE", "65536"))
+
+if DB_SHARDS < 1:
+    raise ValueError(f"Invalid DB_SHARDS: {DB_SHARDS}")
+
+def shard_for_user(user_id: int, shards: int = DB_SHARDS) -> int:
+    """The shard holding a user's conversations."""
+    if shards == 1:
+        return 0
+    return zlib.crc32(str(user_id).encode("ascii")) % shards
+
+def shard_path(directory_file: str, shard: int, shards: int = DB_SHARDS) -> str:
+    """File of one shard; the layout size is part of the name so a reshard never overwrites live files."""
+    if shards == 1:
+        return directory_file
+    root, ext = os.path.splitext(directory_file)
+    return f"{root}.shard{shard}-of-{shards}{ext or '.db'}"
+
+def id_range_start(high_water: int) -> int:
+    """First ID range boundary above every ID allocated so far."""
+    return ((high_water >> SHARD_ID_BITS) + 1) << SHARD_ID_BITS
+
+if __name__ == "__main__":
+    import argparse
+
+    import database
+
+    parser = argparse.ArgumentParser(description="Inspect or change how conversations are sharded.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("status", help="show the current layout and rows per shard")
+    reshard_parser = subcommands.add_parser("reshard", help="move conversations to a new number of shards")
+    reshard_parser.add_argument("shards", type=int)
+    args = parser.parse_args()
+
+    if args.command == "reshard":
+        moved = database.reshard_database(args.shards)
+        print(f"Moved {moved['conversations']} conversations and {moved['messages']} messages to {args.shards} shards")
+        print(f"Start the server with DB_SHARDS={args.shards}")
+    else:
+        for entry in database.get_shard_stats():
+            print(f"{entry['shard']}: {entry['conversations']} conversations, {entry['messages']} messages ({entry['database']})")
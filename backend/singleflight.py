@@ -0,0 +1,115 @@
+"""Single-flight coalescing of identical in-flight LLM requests.
+
+When several requests need the same completion at the same time, only the first
+one starts an upstream call; the others subscribe to it. The upstream stream is
+consumed by its own task and buffered, so every subscriber receives every delta
+from the start (late joiners replay the buffer) and a subscriber that goes away
+does not cancel the call for the rest. Once every subscriber has gone, the
+upstream call is cancelled so it stops holding an admission slot; a request
+for the same key after that starts a new flight.
+
+The flight also carries an `info` dict that the upstream call can fill in
+(e.g. which backend served it); every subscriber gets a copy when the stream
+ends.
+"""
+import asyncio
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+class Flight:
+    """A single upstream stream shared by all subscribers."""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.abandoned = False
+        self.task: Optional[asyncio.Task] = None
+        self.info: Dict = {}
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def append(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.error = error
+        self.done = True
+        self._notify()
+
+    async def subscribe(self, info: Optional[Dict] = None) -> AsyncIterator[str]:
+        """Yield every chunk of the stream, then raise its error if it failed."""
+        self.subscribers += 1
+        try:
+            position = 0
+            while True:
+                while position < len(self.chunks):
+                    yield self.chunks[position]
+                    position += 1
+                if self.done:
+                    if info is not None:
+                        info.update(self.info)
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                # Nobody is waiting for the result any more
+                self.abandoned = True
+                self.task.cancel()
+
+class SingleFlight:
+    """Deduplicates concurrent streams by key."""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._tasks = set()
+        self._stats = {"upstream_calls": 0, "coalesced": 0, "abandoned": 0}
+
+    def stream(
+        self,
+        key: str,
+        start: Callable[[Dict], AsyncIterator[str]],
+        info: Optional[Dict] = None
+    ) -> AsyncIterator[str]:
+        """Subscribe to the in-flight stream for `key`, starting it with `start(flight.info)` if needed.
+
+        `info`, if given, receives the flight's info once the stream ends.
+        """
+        flight = self._flights.get(key)
+        if flight is None or flight.abandoned:
+            flight = Flight()
+            self._flights[key] = flight
+            self._stats["upstream_calls"] += 1
+            flight.task = asyncio.create_task(self._run(key, flight, start))
+            self._tasks.add(flight.task)
+            flight.task.add_done_callback(self._tasks.discard)
+        else:
+            self._stats["coalesced"] += 1
+        return flight.subscribe(info)
+
+    async def _run(self, key: str, flight: Flight, start: Callable[[Dict], AsyncIterator[str]]):
+        error = None
+        try:
+            async for chunk in start(flight.info):
+                flight.append(chunk)
+        except BaseException as e:
+            error = e
+        finally:
+            # Later requests start a new flight (or hit the response cache)
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if flight.abandoned:
+                self._stats["abandoned"] += 1
+            flight.finish(error)
+
+    def stats(self) -> Dict:
+        return {"in_flight": len(self._flights), **self._stats}
+
+llm_flights = SingleFlight()
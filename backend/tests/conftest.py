@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# The backend modules read their settings at import time
+_tmp_dir = tempfile.mkdtemp(prefix="anime-haven-tests-")
+os.environ["DATABASE_FILE"] = os.path.join(_tmp_dir, "test.db")
+os.environ["ARCHIVE_DIR"] = os.path.join(_tmp_dir, "archive")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,57 @@
+import sqlite3
+
+import pytest
+
+import compression
+import database
+import shards
+from migrations import DIRECTORY, HOT_QUERIES, MIGRATIONS, SHARD, explain_hot_queries, find_unindexed_queries, get_schema_version
+
+def connect(path):
+    connection = sqlite3.connect(path)
+    compression.install(connection)
+    return connection
+
+def tables(connection):
+    return {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+
+@pytest.fixture(scope="module")
+def conn():
+    database.initialize_database()
+    connection = connect(database.DATABASE_FILE)
+    yield connection
+    connection.close()
+
+@pytest.fixture
+def sharded(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE_FILE", str(tmp_path / "sharded.db"))
+    monkeypatch.setattr(shards, "DB_SHARDS", 2)
+    database.initialize_database()
+    connections = [connect(path) for path in [database.DATABASE_FILE, *database.shard_files()]]
+    yield connections[0], connections[1:]
+    for connection in connections:
+        connection.close()
+
+def test_migrations_reach_latest_version(conn):
+    assert get_schema_version(conn) == MIGRATIONS[-1][0]
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+def test_hot_query_uses_index(conn, name):
+    plan = explain_hot_queries(conn)[name]
+    assert name not in find_unindexed_queries(conn), "\n".join(plan)
+
+def test_shards_hold_only_conversation_tables(sharded):
+    directory, shard_conns = sharded
+    assert {"users", "llm_cache", "llm_usage", "conversation_directory", "compression_dicts"} <= tables(directory)
+    assert not {"conversations", "messages", "messages_fts"} & tables(directory)
+    for shard in shard_conns:
+        assert {"conversations", "messages", "conversation_summaries", "messages_fts"} <= tables(shard)
+        assert not {"users", "llm_cache", "llm_usage", "conversation_directory", "shard_layout", "compression_dicts"} & tables(shard)
+        assert get_schema_version(shard, DIRECTORY) == 0
+        assert get_schema_version(shard, SHARD) == max(m[0] for m in MIGRATIONS if m[1] == SHARD)
+
+def test_sharded_hot_queries_use_index(sharded):
+    directory, shard_conns = sharded
+    assert not find_unindexed_queries(directory, (DIRECTORY,))
+    for shard in shard_conns:
+        assert not find_unindexed_queries(shard, (SHARD,))
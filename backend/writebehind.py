@@ -0,0 +1,153 @@
+"""Group-commit write path for chat turns.
+
+DB_WRITE_MODE selects how save_turn() persists a turn:
+
+- "sync" (default): write the turn in its own transaction before returning.
+- "group": hand the turn to a background writer that commits turns from
+  concurrent requests together, and wait for that commit. Same durability as
+  "sync", far fewer fsyncs under load.
+- "async": enqueue and return immediately (write-behind). Turns still queued
+  are lost if the process crashes and a follow-up request may briefly not see
+  the previous turn; the queue is flushed on a clean shutdown.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+import async_db
+import database
+import metrics
+
+DB_WRITE_MODE = os.getenv("DB_WRITE_MODE", "sync")
+DB_GROUP_COMMIT_MAX_BATCH = int(os.getenv("DB_GROUP_COMMIT_MAX_BATCH", "64"))
+DB_GROUP_COMMIT_WINDOW_MS = float(os.getenv("DB_GROUP_COMMIT_WINDOW_MS", "5"))
+
+if DB_WRITE_MODE not in ("sync", "group", "async"):
+    raise ValueError(f"Invalid DB_WRITE_MODE: {DB_WRITE_MODE}")
+
+_STOP = object()
+
+class GroupCommitWriter:
+    """Background thread that commits queued turns in batches."""
+
+    def __init__(self, max_batch: int = DB_GROUP_COMMIT_MAX_BATCH, window_ms: float = DB_GROUP_COMMIT_WINDOW_MS):
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats = {"turns": 0, "commits": 0, "failed": 0}
+
+    def submit(self, conversation_id: int, user_content: str, assistant_content: str) -> Future:
+        """Queue a turn; the future resolves to its (user, assistant) message IDs."""
+        with self._lock:
+            # Start (or restart, should it ever have died) the writer thread
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._thread.start()
+        future: Future = Future()
+        self._queue.put(((conversation_id, user_content, assistant_content), future))
+        return future
+
+    def _next_batch(self) -> Tuple[List, bool]:
+        item = self._queue.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _commit_all(self, batch: List):
+        # One transaction per shard
+        try:
+            by_shard: Dict[int, List] = {}
+            for item in batch:
+                by_shard.setdefault(database.conversation_shard(item[0][0]), []).append(item)
+            for shard_batch in by_shard.values():
+                self._commit(shard_batch)
+        except Exception as e:
+            # Never leave a caller waiting, and keep the thread alive for the next batch
+            print(f"Error committing turns: {e}")
+            unresolved = [future for _, future in batch if not future.done()]
+            with self._lock:
+                self._stats["failed"] += len(unresolved)
+            for future in unresolved:
+                future.set_result(None)
+
+    def _commit(self, batch: List):
+        results = database.add_turns([turn for turn, _ in batch])
+        if results:
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+            commits = 1
+        else:
+            # Retry one by one so a single bad turn doesn't fail the batch
+            commits = 0
+            for turn, future in batch:
+                result = database.add_turn(*turn)
+                if result is None:
+                    with self._lock:
+                        self._stats["failed"] += 1
+                    print(f"Error saving turn for conversation {turn[0]}")
+                else:
+                    commits += 1
+                future.set_result(result)
+        with self._lock:
+            self._stats["turns"] += len(batch)
+            self._stats["commits"] += commits
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._commit_all(batch)
+        # Drain anything queued behind the stop marker
+        leftover = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP:
+                leftover.append(item)
+        if leftover:
+            self._commit_all(leftover)
+
+    def close(self):
+        """Flush every queued turn and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"mode": DB_WRITE_MODE, "queued": self._queue.qsize(), **self._stats}
+
+turn_writer = GroupCommitWriter()
+
+async def save_turn(conversation_id: int, user_content: str, assistant_content: str) -> Optional[Tuple[int, int]]:
+    """Persist a chat turn according to DB_WRITE_MODE.
+
+    Returns the message IDs, or None in "async" mode (not yet written).
+    """
+    if DB_WRITE_MODE == "sync":
+        return await async_db.add_turn(conversation_id, user_content, assistant_content)
+
+    with metrics.stage_timer("db_write"):
+        future = turn_writer.submit(conversation_id, user_content, assistant_content)
+        if DB_WRITE_MODE == "group":
+            return await asyncio.wrap_future(future)
+    return None